@@ -1,86 +1,287 @@
 # app.py
-from flask import Flask, render_template, request # Added request
-import pymongo
+from flask import Flask, Response, render_template, request, url_for, jsonify # Added request
+from werkzeug.utils import secure_filename
+import hashlib
+import hmac
 import os
-import pandas as pd
-from collections import defaultdict # Added for easier processing
+import threading
+import time
 import traceback # For detailed error printing
-import networkx as nx # Add this import at the top of app.py
-from networkx.algorithms import community as nx_community # Use alias to avoid name conflicts
+import numpy as np
+from trade_matrix import TradeMatrix, get_trade_matrix, refresh_trade_matrix, patch_trade_matrix, WORLD
+from trade_graph import get_export_graph, get_consensus, peek_export_graph, advance_graphs
+from trade_queries import (country_detail_from_db, bilateral_lookup_from_db, bilateral_summary, fetch_distinct_countries,
+                           latest_year, fetch_years, country_trend_from_db, pair_trend_from_db,
+                           empty_world_data, summary_document, country_summary_from_db, write_country_summaries,
+                           update_country_summaries, rank_countries_from_db, rank_partners_from_db, bump_data_version,
+                           shared_data_version, latest_update,
+                           RECORD_FIELDS, records_query, records_page_from_db, iter_records_from_db)
+from mongo import get_db, get_client, db_status
+from network_analytics import NetworkAnalyticsCache
+from centrality import BACKENDS as CENTRALITY_BACKENDS
+from http_cache import API_MAX_AGE, cached_json, api_error, compress_response
+from metrics import debug, span, count_rows, instrument_app, render_metrics
+from jobs import JobManager, JOB_KINDS, normalize_params, public_job
+from change_feed import ChangeFeed
+from pagination import (encode_cursor, decode_cursor, partner_cursor, page_size, partner_rows, page_rows, stream_csv,
+                        stream_json, EXPORT_FORMATS, PARTNER_SORTS, PARTNER_FIELDS, RECORD_CURSOR)
 
 # Initialize the Flask application
 app = Flask(__name__)
+instrument_app(app) # Request and template timings for /metrics (see metrics.py)
 
-# --- MongoDB Configuration ---
-MONGO_URI = os.environ.get("MONGO_URI") # NEW LINE using environment variable
-
-# Initialize MongoDB Client
-db_status = "MongoDB status unknown"
-client = None
-db = None
-try:
-    client = pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    client.admin.command('ismaster')
-    db_status = "MongoDB connection successful!"
-    db = client['trade_db']
-except pymongo.errors.ConnectionFailure as e:
-    print(f"Could not connect to MongoDB: {e}")
-    db_status = f"MongoDB connection failed: {e}"
-    client = None
-except Exception as e:
-    print(f"An error occurred during MongoDB initialization: {e}")
-    db_status = f"MongoDB initialization error: {e}"
-    client = None
-
-# --- Get Distinct Country List (Run Once at Startup - Improved) ---
-distinct_countries = []
-if db is not None: # Check if db connection exists
+# --- Configuration ---
+# MongoDB is reached lazily through mongo.get_db() (MONGO_URI, MONGO_DB, MONGO_MAX_POOL_SIZE, ...)
+# Serve routes from the shared in-memory trade matrix (set to 0 to query MongoDB per request)
+USE_TRADE_MATRIX = os.environ.get("USE_TRADE_MATRIX", "1") != "0"
+# Default centrality engine for /network_analysis ("networkx" or "sparse"); ?backend= overrides per request
+CENTRALITY_BACKEND = os.environ.get("CENTRALITY_BACKEND", "networkx")
+COUNTRY_LIST_TTL = 600 # Seconds before the MongoDB-derived country list is refreshed in the background
+RANKING_MAX_LIMIT = 500 # Rows per /api/rankings response
+# POST /reload_data needs this in X-Reload-Token (or Authorization: Bearer ...); unset, it is refused
+RELOAD_TOKEN = os.environ.get("RELOAD_TOKEN")
+# Only when the app is served directly (no reverse proxy, which makes every client look local):
+# allow /reload_data from localhost without a token
+RELOAD_ALLOW_LOCALHOST = os.environ.get("RELOAD_ALLOW_LOCALHOST", "0") == "1"
+
+# --- Distinct Country List (cached; refreshed in the background, never at import time) ---
+_country_list = {'countries': [], 'loaded_at': None, 'refreshing': False}
+_country_list_lock = threading.Lock()
+
+
+def _refresh_country_list():
     try:
-        print("Fetching distinct country list (reporters and partners) from MongoDB...")
-        pipeline = [
-            {'$match': {'reporter': {'$ne': 'World'}, 'partner': {'$ne': 'World'}}}, # Exclude 'World'
-            {'$group': {'_id': None, 'reporters': {'$addToSet': '$reporter'}, 'partners': {'$addToSet': '$partner'}}},
-            {'$project': {'allCountries': {'$setUnion': ['$reporters', '$partners']}, '_id': 0}}
-        ]
-        result = list(db.trade_records.aggregate(pipeline))
-        if result and 'allCountries' in result[0]:
-            distinct_countries = sorted(result[0]['allCountries'])
-            print(f"Found {len(distinct_countries)} distinct countries (reporters/partners).")
-        else:
-             print("Could not retrieve distinct countries, falling back to reporters only.")
-             distinct_countries = sorted(db.trade_records.distinct("reporter", {"reporter": {"$ne": "World"}}))
+        db = get_db()
+        if db is not None:
+            print("Fetching distinct country list (reporters and partners) from MongoDB...")
+            countries = fetch_distinct_countries(db)
+            print(f"Found {len(countries)} distinct countries (reporters/partners).")
+            _country_list.update(countries=countries, loaded_at=time.monotonic())
     except Exception as e:
         print(f"Error fetching distinct countries: {e}")
-        distinct_countries = ["Error fetching countries"]
-else:
-    print("Skipping country list fetch: No MongoDB connection.")
-    distinct_countries = ["DB connection failed"]
-# --- End of Get Distinct Country List ---
+    finally:
+        _country_list['refreshing'] = False
+
+
+def get_distinct_countries():
+    # The loaded trade matrix already knows every country; otherwise serve the cached list
+    matrix = get_trade_matrix(get_db()) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        return matrix.country_names()
+    loaded_at = _country_list['loaded_at']
+    if loaded_at is None or time.monotonic() - loaded_at > COUNTRY_LIST_TTL:
+        with _country_list_lock:
+            if not _country_list['refreshing']:
+                _country_list['refreshing'] = True
+                threading.Thread(target=_refresh_country_list, name="country-list", daemon=True).start()
+    return _country_list['countries']
+
+
+# --- Load Trade Data ---
+# Data is loaded outside the web app with ingest.py, e.g.:
+#   python ingest.py trade_data_global_2024.csv --snapshot trade_matrix.npz
+
+
+# --- Data access (shared trade matrix, or MongoDB when it is disabled) ---
+_db_version = 0 # Bumped by /reload_data and the change feed; keys the graph caches when there is no trade matrix
+_dataset_key = {'etag': None, 'checked_at': None} # Without a trade matrix: see _dataset_etag
+DATASET_KEY_TTL = 2.0 # Seconds between re-reads of what that ETag is derived from
+_data_update_lock = threading.RLock() # One reload or patch at a time
+
+
+def _selected_year():
+    # ?year=2019 on any view; omitted means the latest year
+    return request.args.get('year', None, type=int)
+
+
+def _invalid_year():
+    # A ?year= that isn't an integer (which _selected_year would take for "latest")
+    return request.args.get('year', '') != '' and _selected_year() is None
+
+
+def _resolve_year(year=None):
+    # Concrete year for a request (None when the dataset has no such year / no data)
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        return matrix.resolve_year(year)
+    if year is not None:
+        return year if year in fetch_years(db) else None
+    return latest_year(db)
+
+
+def _available_years():
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        return matrix.years
+    return fetch_years(db) if db is not None else []
+
+
+def _load_country_detail(selected_country, year=None):
+    # (world_data, partner_data, data_found, trade_year)
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        with span('matrix_query', 'country_detail'):
+            world_data, partner_data, data_found = matrix.country_detail(selected_country, year) # year=None: latest
+        return world_data, partner_data, data_found, matrix.resolve_year(year) if data_found else "N/A"
+    # One keyed read from the materialized country_summaries; until that is built, one
+    # aggregation returns direct + mirror rows already merged per partner
+    return country_summary_from_db(db, selected_country, year) or country_detail_from_db(db, selected_country, year)
+
+
+def _dataset_etag():
+    # Identifies the dataset a response was computed from (used by the /api/... routes)
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        return matrix.fingerprint # Content hash, so every worker hands out the same ETag for the same data
+    if db is None:
+        return None
+    # Derived from what every worker reads alike in MongoDB (the shared data version, bumped
+    # by reloads and bulk loads, and the newest upsert) rather than this process's _db_version
+    now = time.monotonic()
+    if _dataset_key['checked_at'] is None or now - _dataset_key['checked_at'] > DATASET_KEY_TTL:
+        key = f"{shared_data_version(db)}|{latest_update(db)}"
+        _dataset_key.update(etag=hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest(), checked_at=now)
+    return _dataset_key['etag']
+
 
+def _trade_value_lookup(pairs, year=None):
+    # get_trade_value(reporter, partner, flow) for one year, backed by the trade matrix or one batched MongoDB query
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        return lambda reporter, partner, flow_desc: matrix.trade_value(reporter, partner, flow_desc, year) # year=None: latest
+    return bilateral_lookup_from_db(db, pairs, year)
 
-"""
-# --- Load Trade Data --- (This section should remain commented out for normal runs)
-# ... (your previously commented out data loading/processing code) ...
-"""
+
+def _load_trend(country, partner=None, year_from=None, year_to=None):
+    # A country's World totals, or a pair's bilateral flows, for every year in range
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        with span('matrix_query', 'pair_trend' if partner else 'country_trend'):
+            if partner:
+                return matrix.pair_trend(country, partner, year_from, year_to)
+            return matrix.country_trend(country, year_from, year_to)
+    if partner:
+        return pair_trend_from_db(db, country, partner, year_from, year_to)
+    return country_trend_from_db(db, country, year_from, year_to)
+
+
+def _load_rankings(by, order, limit, year, country=None):
+    # Top surplus/deficit countries or country-partner pairs; None when country_summaries isn't built
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        with span('matrix_query', 'rankings'):
+            return matrix.balance_ranking(by, order, limit, year, country)
+    if by == 'countries':
+        return rank_countries_from_db(db, year, order, limit)
+    return rank_partners_from_db(db, year, order, limit, country)
+
+
+def _export_edges(year):
+    # (reporter, partner, value) for every positive, non-World export flow in `year`
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    if matrix is not None:
+        with span('matrix_query', 'export_edges'):
+            src, dst, weights = matrix.export_edges(year)
+        names = np.asarray(matrix.countries, dtype=object)
+        return zip(names[src], names[dst], weights.tolist())
+    query = {
+        "year": year, "partner": {"$ne": "World"}, "reporter": {"$ne": "World"},
+        "flow": "Export", "value": {"$gt": 0}
+    }
+    projection = {"_id": 0, "reporter": 1, "partner": 1, "value": 1}
+    with span('db_query', 'export_edges'):
+        edges = [(r['reporter'], r['partner'], r['value']) for r in db.trade_records.find(query, projection)]
+    count_rows('export_edges', len(edges))
+    return edges
+
+
+# --- Filters, pages and exports for /data and the partner tables (see pagination.py) ---
+def _record_filters():
+    # /data's query string -> (trade_records query, descending, year); ValueError for bad values
+    flow = request.args.get('flow') or None
+    if flow not in (None, 'Export', 'Import'):
+        raise ValueError("'flow' must be Export or Import.")
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("'order' must be asc or desc.")
+    year = _resolve_year(_selected_year())
+    if year is None:
+        raise ValueError(f"No trade data for {_selected_year() or 'any year'}.")
+    query = records_query(year, flow, request.args.get('reporter') or None, request.args.get('partner') or None,
+                          request.args.get('min_value', None, type=float), request.args.get('max_value', None, type=float))
+    return query, order == 'desc', year
+
+
+def _partner_filters():
+    # Partner-table query string -> (sort, descending, flow, search); ValueError for bad values
+    sort = request.args.get('sort', 'partner')
+    if sort not in PARTNER_SORTS:
+        raise ValueError(f"'sort' must be one of: {', '.join(PARTNER_SORTS)}.")
+    order = request.args.get('order', 'asc' if sort == 'partner' else 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("'order' must be asc or desc.")
+    flow = request.args.get('flow') or None
+    if flow not in (None, 'export', 'import'):
+        raise ValueError("'flow' must be export or import.")
+    return sort, order == 'desc', flow, request.args.get('q') or None
+
+
+def _export_format():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"'format' must be one of: {', '.join(EXPORT_FORMATS)}.")
+    return export_format
+
+
+def _export_response(rows, fields, export_format, filename):
+    # A download streamed from a generator: rows are produced as the client reads them
+    body = stream_json(rows, fields) if export_format == 'json' else stream_csv(rows, fields)
+    mimetype = 'application/json' if export_format == 'json' else 'text/csv'
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(filename) or "export"}.{export_format}"'
+    response.cache_control.no_store = True
+    return response
+
+
+@app.template_global()
+def page_url(endpoint=None, **changes):
+    # The current page's (or `endpoint`'s) URL with the current query arguments, some replaced
+    # (None drops one)
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(endpoint or request.endpoint, **{key: value for key, value in args.items() if value is not None})
 
 
 # --- Routes ---
 @app.route('/')
 def index():
     # Pass the enhanced country list to the index template
+    get_db() # Connect (or retry) so the status below is current
     return render_template('index.html',
-                           db_status=db_status,
-                           countries=distinct_countries)
+                           db_status=db_status(),
+                           countries=get_distinct_countries())
 
 
 @app.route('/country_detail')
 def country_detail():
-    # ... (Code for single country view with mirror flows - from previous step) ...
+    db = get_db()
     selected_country = request.args.get('country_name')
-    partner_data = defaultdict(lambda: {'export': 0, 'import': 0, 'balance': 0, 'export_reported': False, 'import_reported': False})
-    world_data = {'export': 0, 'import': 0, 'balance': 0, 'export_reported': False, 'import_reported': False, 'export_calculated': False, 'import_calculated': False}
+    final_partner_data = {}
+    world_data = empty_world_data()
     error_message = None
     trade_year = "N/A"
+    year = _selected_year()
+    # The partner table is sorted, filtered and paged here; the page renders one page of rows
+    partners, partner_count, next_cursor = [], 0, None
+    sort, descending = 'partner', False
 
     if not selected_country:
         error_message = "No country selected."
@@ -88,133 +289,57 @@ def country_detail():
         error_message = "Database connection not available."
     else:
         try:
-            print(f"Processing data for: {selected_country}")
-            # 1. Get DIRECT data
-            print("Fetching direct data...")
-            direct_cursor = db.trade_records.find({'reporter': selected_country})
-            direct_data_found = False
-            for record in direct_cursor:
-                direct_data_found = True
-                trade_year = record['year']
-                partner = record['partner']
-                flow = record['flow']
-                value = record['value']
-                if partner == "World":
-                    if flow == "Export": world_data['export'] = value; world_data['export_reported'] = True
-                    elif flow == "Import": world_data['import'] = value; world_data['import_reported'] = True
-                else:
-                    if flow == "Export": partner_data[partner]['export'] = value; partner_data[partner]['export_reported'] = True
-                    elif flow == "Import": partner_data[partner]['import'] = value; partner_data[partner]['import_reported'] = True
-            print(f"Direct data found: {direct_data_found}")
-
-            # 2. Get MIRROR data
-            print("Fetching mirror data...")
-            mirror_cursor = db.trade_records.find({'partner': selected_country})
-            mirror_data_found = False
-            for record in mirror_cursor:
-                mirror_data_found = True
-                trade_year = record['year']
-                reporter_as_partner = record['reporter']
-                flow = record['flow']
-                value = record['value']
-                if flow == "Export": # Partner exported TO selected_country -> Selected country's IMPORT
-                    if not partner_data[reporter_as_partner]['import_reported']: partner_data[reporter_as_partner]['import'] = value
-                elif flow == "Import": # Partner imported FROM selected_country -> Selected country's EXPORT
-                    if not partner_data[reporter_as_partner]['export_reported']: partner_data[reporter_as_partner]['export'] = value
-            print(f"Mirror data found: {mirror_data_found}")
-
-            # 3. Calculate Balances for Partners
-            print("Calculating partner balances...")
-            final_partner_data = dict(partner_data)
-            for partner, data in final_partner_data.items(): data['balance'] = data['export'] - data['import']
-
-            # 4. Calculate World Totals if direct data wasn't found
-            print("Checking and calculating World totals...")
-            calculated_world_export = 0; calculated_world_import = 0
-            if not world_data['export_reported'] or not world_data['import_reported']:
-                print("Direct World data incomplete, calculating from partners...")
-                for partner, data in final_partner_data.items():
-                    calculated_world_export += data.get('export', 0)
-                    calculated_world_import += data.get('import', 0)
-                if not world_data['export_reported']:
-                    world_data['export'] = calculated_world_export; world_data['export_calculated'] = True
-                    print(f"Calculated World Export Total: {calculated_world_export}")
-                if not world_data['import_reported']:
-                    world_data['import'] = calculated_world_import; world_data['import_calculated'] = True
-                    print(f"Calculated World Import Total: {calculated_world_import}")
-            world_data['balance'] = world_data['export'] - world_data['import']
-            print(f"Final World Data: {world_data}")
-
-            if not direct_data_found and not mirror_data_found: error_message = f"No trade data found involving {selected_country} as reporter or partner."
+            debug(f"Processing data for: {selected_country}")
+            world_data, final_partner_data, data_found, trade_year = _load_country_detail(selected_country, year)
 
+            if not data_found: error_message = f"No trade data found involving {selected_country} as reporter or partner" + (f" in {year}." if year else ".")
+
+            sort, descending, flow, search = _partner_filters()
+            rows = partner_rows(final_partner_data, sort, descending, flow, search)
+            partner_count = len(rows)
+            after = decode_cursor(request.args.get('after'), partner_cursor(sort))
+            partners, next_cursor = page_rows(rows, sort, descending, after, page_size(request.args.get('limit')))
+        except ValueError as e:
+            error_message = str(e)
         except Exception as e:
             error_message = f"Error processing data for {selected_country}: {e}\n{traceback.format_exc()}"; print(error_message)
 
     return render_template('country_view.html',
                            selected_country=selected_country, year=trade_year,
-                           world_data=world_data, partner_data=final_partner_data,
+                           world_data=world_data, partners=partners, partner_total=len(final_partner_data),
+                           partner_count=partner_count, next_cursor=next_cursor,
+                           sort=sort, order='desc' if descending else 'asc',
+                           years=_available_years() if db is not None else [],
                            error=error_message)
 
 
 # --- NEW: Route for Two-Country Comparison ---
 @app.route('/compare')
 def compare_countries():
+    db = get_db()
     country_A = request.args.get('country_A')
     country_B = request.args.get('country_B')
     trade_data = None # Initialize as None
     error_message = None
     trade_year = "N/A"
+    year = _selected_year()
 
     if not country_A or not country_B:
         error_message = "Please select two countries to compare."
     elif country_A == country_B:
         error_message = "Please select two different countries."
+    elif _invalid_year():
+        error_message = "'year' must be an integer."
     elif db is None:
         error_message = "Database connection not available."
+    elif _resolve_year(year) is None:
+        error_message = f"No trade data for {year or 'any year'}."
     else:
         try:
-            print(f"Comparing trade between {country_A} and {country_B}")
-
-            # Helper function (can be defined outside or inside, careful with scope if outside)
-            def get_trade_value(reporter, partner, flow_desc):
-                # Try direct report first
-                direct_query = {'reporter': reporter, 'partner': partner, 'flow': flow_desc}
-                direct_result = db.trade_records.find_one(direct_query)
-                if direct_result:
-                    return direct_result.get('value', 0), True, direct_result.get('year', None)
-
-                # If direct not found, try mirror report
-                mirror_flow_desc = "Import" if flow_desc == "Export" else "Export"
-                mirror_query = {'reporter': partner, 'partner': reporter, 'flow': mirror_flow_desc}
-                mirror_result = db.trade_records.find_one(mirror_query)
-                if mirror_result:
-                    return mirror_result.get('value', 0), False, mirror_result.get('year', None)
-
-                # If neither found
-                return 0, False, None
-
-            # Get A -> B flow (A's Export to B), prioritize A's report
-            A_to_B_value, A_to_B_reported, year1 = get_trade_value(country_A, country_B, "Export")
-
-            # Get B -> A flow (B's Export to A), prioritize B's report
-            # This value represents A's Imports from B
-            B_to_A_value, B_to_A_reported, year2 = get_trade_value(country_B, country_A, "Export")
-
-            # Determine the year (use valid year if found)
-            trade_year = year1 if year1 is not None else year2 if year2 is not None else "N/A"
-            if isinstance(trade_year, list): trade_year = trade_year[0] # Handle potential list if $first was used
-
-            # Calculate balance from A's perspective (A's Exports - A's Imports)
-            balance = A_to_B_value - B_to_A_value
-
-            trade_data = {
-                'A_to_B_value': A_to_B_value,
-                'A_to_B_reported': A_to_B_reported, # True if A reported Export to B
-                'B_to_A_value': B_to_A_value,
-                'B_to_A_reported': B_to_A_reported, # True if B reported Export to A
-                'balance': balance
-            }
-            print(f"Comparison data: {trade_data}")
+            debug(f"Comparing trade between {country_A} and {country_B}")
+            trade_data = bilateral_summary(_trade_value_lookup([(country_A, country_B)], year), country_A, country_B)
+            trade_year = trade_data['year']
+            debug(f"Comparison data: {trade_data}")
 
         except Exception as e:
             error_message = f"Error processing comparison for {country_A} and {country_B}: {e}\n{traceback.format_exc()}"
@@ -225,31 +350,131 @@ def compare_countries():
                             country_B=country_B,
                             year=trade_year,
                             trade_data=trade_data, # Pass dictionary directly
+                            years=_available_years() if db is not None else [],
                             error=error_message)
 
 
+MAX_COMPARE_PAIRS = 1000 # Upper bound for one /api/compare_batch call
+
+
+# --- Batched bilateral comparison (JSON) ---
+# POST {"pairs": [["A", "B"], ...]} or {"country": "A", "partners": ["B", "C"]}, optionally with "year",
+# or GET /api/compare_batch?country=A&partner=B&partner=C[&year=2019]
+@app.route('/api/compare_batch', methods=['GET', 'POST'])
+def compare_batch():
+    db = get_db()
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        if payload is None:
+            payload = {}
+        if not isinstance(payload, dict):
+            return api_error("Request body must be a JSON object.", 400)
+        if not isinstance(payload.get('pairs') or [], list) or not isinstance(payload.get('partners') or [], list):
+            return api_error("'pairs' and 'partners' must be lists.", 400)
+        pairs = payload.get('pairs') or [(payload.get('country'), p) for p in payload.get('partners') or []]
+        year = payload.get('year')
+    else:
+        pairs = [(request.args.get('country'), p) for p in request.args.getlist('partner')]
+        year = _selected_year()
+
+    if not pairs:
+        return api_error("Provide 'pairs', or 'country' with 'partners'.", 400)
+    if len(pairs) > MAX_COMPARE_PAIRS:
+        return api_error(f"At most {MAX_COMPARE_PAIRS} pairs per request.", 400)
+    if any(not isinstance(pair, (list, tuple)) or len(pair) != 2 or not all(isinstance(c, str) and c for c in pair) for pair in pairs):
+        return api_error("Each pair must be two country names.", 400)
+    if year is not None and (isinstance(year, bool) or not isinstance(year, int)):
+        return api_error("'year' must be an integer.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+
+    def build():
+        get_trade_value = _trade_value_lookup(pairs, year) # One lookup structure (or one query) for every pair
+        results = []
+        for country_A, country_B in pairs:
+            if country_A == country_B:
+                results.append({'country_A': country_A, 'country_B': country_B, 'error': "Please select two different countries."})
+                continue
+            results.append({'country_A': country_A, 'country_B': country_B, **bilateral_summary(get_trade_value, country_A, country_B)})
+        return {'count': len(results), 'results': results}, 200
+
+    try:
+        # Only GETs are cacheable; a POST body isn't part of the cache key
+        return cached_json(_dataset_etag() if request.method == 'GET' else None, build)
+    except Exception as e:
+        print(f"Error processing batch comparison: {e}\n{traceback.format_exc()}")
+        return api_error(f"Error processing batch comparison: {e}", 500)
+
+
 # Keep other routes for testing
 @app.route('/data')
 def show_data():
-    # ... (previous code for /data) ...
+    # One year's raw records, largest values first, filtered and paged server-side
+    # (?flow=, ?reporter=, ?partner=, ?min_value=, ?max_value=, ?order=, ?limit=, ?after=<cursor>)
+    db = get_db()
     records_list = []
     error_message = None
+    next_cursor, year = None, None
     if db is not None:
         try:
-            trade_cursor = db.trade_records.find().sort('value', pymongo.DESCENDING).limit(20)
-            records_list = list(trade_cursor)
-            print(f"Retrieved {len(records_list)} records from MongoDB for display.")
+            query, descending, year = _record_filters()
+            after = decode_cursor(request.args.get('after'), RECORD_CURSOR)
+            records_list, next_key = records_page_from_db(db, query, descending, after, page_size(request.args.get('limit')))
+            next_cursor = encode_cursor(next_key) if next_key else None
+            debug(f"Retrieved {len(records_list)} records from MongoDB for display.")
+        except ValueError as e:
+            error_message = str(e)
         except Exception as e:
             error_message = f"Error querying MongoDB: {e}"
             print(error_message)
     else:
         error_message = "Database connection not available."
-    return render_template('trade_data.html', records=records_list, error=error_message)
+    return render_template('trade_data.html', records=records_list, next_cursor=next_cursor, year=year,
+                           years=_available_years() if db is not None else [], error=error_message)
+
+
+# GET /api/data: the same pages as JSON ({records, next_cursor}; pass next_cursor back as ?after=)
+@app.route('/api/data')
+def api_data():
+    db = get_db()
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    try:
+        query, descending, year = _record_filters()
+        after, limit = decode_cursor(request.args.get('after'), RECORD_CURSOR), page_size(request.args.get('limit'))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    def build():
+        records, next_key = records_page_from_db(db, query, descending, after, limit)
+        return {'year': year, 'records': records, 'next_cursor': encode_cursor(next_key) if next_key else None}, 200
+
+    try:
+        return cached_json(_dataset_etag(), build)
+    except Exception as e:
+        print(f"Error fetching trade records: {e}\n{traceback.format_exc()}")
+        return api_error(f"Error fetching trade records: {e}", 500)
+
+
+# GET /data/export?format=csv|json (+ the /data filters): every matching record, streamed
+@app.route('/data/export')
+def export_data():
+    db = get_db()
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    try:
+        query, descending, year = _record_filters()
+        export_format = _export_format()
+    except ValueError as e:
+        return api_error(str(e), 400)
+    return _export_response(iter_records_from_db(db, query, descending), RECORD_FIELDS, export_format, f"trade_records_{year}")
 
 
 @app.route('/test_db')
 def test_db_connection():
     # ... (previous code for /test_db) ...
+    db = get_db()
+    client = get_client()
     if client and db is not None:
         try:
             collection_names = db.list_collection_names()
@@ -261,152 +486,259 @@ def test_db_connection():
             return f"Connected, but error listing collections/counting documents: {e}"
     else:
         return "Failed to establish connection with MongoDB client or database."
+
+
+@app.route('/reload_data', methods=['POST'])
+def reload_data():
+    # Hook for when trade_records changes in bulk (or records were deleted): rebuild everything
+    # here, then bump the shared data version so the other processes reload too (see change_feed.py)
+    if not _reload_allowed():
+        return "Forbidden: set RELOAD_TOKEN and send it in X-Reload-Token.", 403
+    db = get_db()
+    if db is None:
+        return "Database connection not available.", 503
+    try:
+        message = _full_reload(db)
+        version = bump_data_version(db)
+        change_feed.mark_reloaded(version)
+        return f"{message} Shared data version {version}."
+    except Exception as e:
+        print(f"Error reloading trade matrix: {e}")
+        return f"Error reloading trade matrix: {e}", 500
     
 
+def _reload_allowed():
+    if RELOAD_TOKEN:
+        auth = request.headers.get('Authorization', '')
+        supplied = request.headers.get('X-Reload-Token') or (auth[7:] if auth.startswith('Bearer ') else '')
+        return hmac.compare_digest(supplied.encode(), RELOAD_TOKEN.encode())
+    return RELOAD_ALLOW_LOCALHOST and request.remote_addr in ('127.0.0.1', '::1')
+
+
+def _full_reload(db, write_summaries=True):
+    # write_summaries=False reloads this process only (another one rebuilds country_summaries)
+    global _db_version
+    with _data_update_lock:
+        if not USE_TRADE_MATRIX:
+            _db_version += 1
+            for cache in list(network_caches.values()): cache.invalidate(_db_version)
+            if write_summaries:
+                _rebuild_country_summaries(db)
+            return f"Data version bumped to {_db_version}."
+        matrix = refresh_trade_matrix(db)
+        for cache in list(network_caches.values()): cache.invalidate(matrix.version)
+        if write_summaries:
+            _rebuild_country_summaries(db, matrix)
+        return f"Trade matrix reloaded: {len(matrix)} countries, version {matrix.version}."
+
+
+def _rebuild_country_summaries(db, matrix=None):
+    # One batch pass, from the fresh trade matrix or else a throwaway one built from the collection
+    try:
+        matrix = matrix or TradeMatrix.from_collection(db.trade_records)
+        written = write_country_summaries(db, matrix.summary_documents(), matrix.years)
+        debug(f"Rebuilt country_summaries: {written} documents.")
+    except Exception as e:
+        print(f"Error rebuilding country_summaries: {e}")
+
+
+def _patch_country_summaries(db, records, matrix=None):
+    # Only the reporter's and the partner's summaries for a changed record's year can change
+    affected = {(record['year'], country) for record in records for country in (record['reporter'], record['partner'])}
+    try:
+        if matrix is not None:
+            documents = list(matrix.summary_documents(affected))
+        else:
+            documents = []
+            for year, country in affected:
+                world_data, partner_data, data_found, _ = country_detail_from_db(db, country, year)
+                if data_found:
+                    documents.append(summary_document(year, country, world_data, partner_data))
+        update_country_summaries(db, documents, affected)
+    except Exception as e:
+        print(f"Error updating country_summaries: {e}")
+
+
+def _data_version():
+    db = get_db()
+    matrix = get_trade_matrix(db) if USE_TRADE_MATRIX else None
+    return matrix.version if matrix is not None else _db_version
+
+
+def _graph_for_year(year):
+    # The shared export graph for one year, keyed by (data version, year)
+    version = _data_version()
+    return version, get_export_graph((version, year), lambda: _export_edges(year))
+
+
+def _consensus_for_year(version, year, resolution=1.0, allow_stale=True, wait=True):
+    # Consensus of many seeded Louvain runs, so every page and worker shows the same partition
+    return get_consensus((version, year), lambda: _export_edges(year), resolution=resolution, allow_stale=allow_stale, wait=wait)
+
+
+# Precomputed network analytics per (centrality backend, year), created on first request and
+# refreshed in the background when the data version changes
+network_caches = {}
+_network_caches_lock = threading.Lock()
+# Seconds a request waits for the very first snapshot; by default none (the page reloads itself)
+NETWORK_ANALYTICS_WAIT = float(os.environ.get("NETWORK_ANALYTICS_WAIT", "0"))
+
+
+def _network_cache(backend, year):
+    with _network_caches_lock:
+        cache = network_caches.get((backend, year))
+        if cache is None:
+            cache = network_caches[(backend, year)] = NetworkAnalyticsCache(
+                lambda: _graph_for_year(year), lambda version: _consensus_for_year(version, year, allow_stale=False)['communities'],
+                top_n=20, backend=backend)
+        return cache
+
+
+# --- Incremental updates: changed records patch the matrix, graphs, cheap metrics and
+# country summaries (see change_feed.py) ---
+def _apply_trade_changes(records, write_summaries=True):
+    global _db_version
+    db = get_db()
+    with _data_update_lock:
+        old_version, matrix = _data_version(), None
+        if USE_TRADE_MATRIX and get_trade_matrix(db) is not None:
+            matrix = patch_trade_matrix(records)
+            if matrix is None: # A new country or year: the matrix needs new rows
+                print("Changed trade records add a country or year; reloading the trade matrix.")
+                _full_reload(db, write_summaries)
+                return
+            new_version = matrix.version
+        else:
+            _db_version += 1
+            new_version = _db_version
+        if write_summaries:
+            _patch_country_summaries(db, records, matrix)
+        # Country views and World-total fallbacks read the patched matrix directly; the export
+        # graphs only need their changed edges
+        edge_changes = {}
+        for record in records:
+            if record.get('flow') == 'Export' and WORLD not in (record.get('reporter'), record.get('partner')):
+                edge_changes.setdefault(record['year'], []).append((record['reporter'], record['partner'], record.get('value') or 0))
+        advance_graphs(old_version, new_version, edge_changes)
+        for (backend, year), cache in list(network_caches.items()):
+            cache.advance(old_version, new_version, peek_export_graph((new_version, year)), year in edge_changes)
+    debug(f"Applied {len(records)} changed trade records (data version {old_version} -> {new_version}).")
+
+
+change_feed = ChangeFeed(get_db, _apply_trade_changes, lambda write_summaries: _full_reload(get_db(), write_summaries))
+app.before_request(change_feed.ensure_started) # Started per process, on its first request (TRADE_CHANGE_FEED=0 disables)
+
+
+# --- Background analysis jobs: custom parameters run in a process pool (see jobs.py) ---
+job_manager = JobManager(get_db)
+NETWORK_JOB_ARGS = ('top_n', 'weight_threshold', 'resolution', 'seed') # Any of these turns /network_analysis into a job
+CLUSTER_JOB_ARGS = ('resolution', 'seed', 'weight_threshold') # Likewise for /clusters
+
+
+def _submit_job(kind, raw_params, year=None):
+    # (job document, error_message); identical submissions share one job
+    resolved = _resolve_year(year)
+    if resolved is None:
+        return None, f"No trade data for {year or 'any year'}."
+    params, error_message = normalize_params(kind, raw_params)
+    if error_message:
+        return None, error_message
+    return job_manager.submit(kind, params, _dataset_etag(), resolved, lambda: _export_edges(resolved)), None
+
+
+def _page_job(kind, triggers):
+    # Pages switch to a background job when any of `triggers` is in the query string;
+    # returns (public job or None, error_message)
+    if not any(key in request.args for key in triggers):
+        return None, None
+    raw_params = {key: request.args[key] for key in JOB_KINDS[kind] if key in request.args}
+    doc, error_message = _submit_job(kind, raw_params, _selected_year())
+    return (public_job(doc) if doc else None), error_message
+
+
 @app.route('/network_analysis')
 def network_analysis():
+    db = get_db()
     error_message = None
-    centrality_results = {} # Dictionary to hold centrality results
-    community_results = [] # List to hold communities
-    graph_info = {} # Dictionary for basic graph info
+    snapshot, status, job = None, {}, None
+    backend = request.args.get('backend', CENTRALITY_BACKEND)
+    year = _resolve_year(_selected_year()) if db is not None else None
 
     if db is None:
         error_message = "Database connection not available."
+    elif backend not in CENTRALITY_BACKENDS:
+        error_message = f"Unknown centrality backend '{backend}'. Choose from: {', '.join(CENTRALITY_BACKENDS)}"
+    elif year is None:
+        error_message = f"No trade data for {_selected_year() or 'any year'}."
+    elif any(key in request.args for key in NETWORK_JOB_ARGS):
+        # Custom parameters: computed as a job, this page polls it
+        try:
+            job, error_message = _page_job('network_analysis', NETWORK_JOB_ARGS)
+            if job and job['status'] == 'done':
+                snapshot = {**job['result'], 'error': None}
+            elif job and job['status'] == 'failed':
+                error_message = job['error']
+        except Exception as e:
+            error_message = f"Error submitting network analysis job: {e}\n{traceback.format_exc()}"
+            print(error_message)
     else:
         try:
-            print("Fetching data for network graph construction...")
-            query = {
-                "partner": {"$ne": "World"}, "reporter": {"$ne": "World"},
-                "flow": "Export", "value": {"$gt": 0}
-            }
-            projection = {"_id": 0, "reporter": 1, "partner": 1, "value": 1}
-            trade_data = list(db.trade_records.find(query, projection))
-
-            if not trade_data:
-                error_message = "No suitable trade data found in database to build network (check filters)."
-            else:
-                print(f"Building network graph from {len(trade_data)} export records...")
-                G = nx.DiGraph() # Directed graph
-                for record in trade_data:
-                    G.add_edge(record['reporter'], record['partner'], weight=record['value'])
-
-                # Ensure graph is not empty before proceeding
-                if G.number_of_nodes() == 0 or G.number_of_edges() == 0:
-                     error_message = "Graph could not be built (no valid nodes/edges)."
-                else:
-                    print(f"Graph built with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges.")
-                    graph_info['nodes'] = G.number_of_nodes()
-                    graph_info['edges'] = G.number_of_edges()
-
-                    # --- Calculate Centralities ---
-                    top_n = 20
-                    # Degree
-                    print("Calculating In/Out Degree...")
-                    in_degree = dict(G.in_degree())
-                    out_degree = dict(G.out_degree())
-                    centrality_results['in_degree'] = sorted(in_degree.items(), key=lambda item: item[1], reverse=True)[:top_n]
-                    centrality_results['out_degree'] = sorted(out_degree.items(), key=lambda item: item[1], reverse=True)[:top_n]
-                    # Betweenness
-                    print("Calculating Betweenness Centrality (weighted)...")
-                    try:
-                        betweenness = nx.betweenness_centrality(G, weight='weight', normalized=True)
-                        centrality_results['betweenness'] = sorted(betweenness.items(), key=lambda item: item[1], reverse=True)[:top_n]
-                        print("Betweenness calculation complete.")
-                    except Exception as e_between:
-                        print(f"Error calculating betweenness centrality: {e_between}")
-                        centrality_results['betweenness'] = [("Calculation Error", f"{e_between}")]
-                    # Eigenvector
-                    print("Calculating Eigenvector Centrality (weighted)...")
-                    try:
-                        eigenvector = nx.eigenvector_centrality(G, weight='weight', max_iter=1000, tol=1e-03)
-                        centrality_results['eigenvector'] = sorted(eigenvector.items(), key=lambda item: item[1], reverse=True)[:top_n]
-                        print("Eigenvector calculation complete.")
-                    except nx.PowerIterationFailedConvergence as e_eigen_conv:
-                        print(f"Eigenvector Centrality did not converge: {e_eigen_conv}")
-                        centrality_results['eigenvector'] = [("Convergence Error", f"{e_eigen_conv}")]
-                    except Exception as e_eigen:
-                        print(f"Error calculating eigenvector centrality: {e_eigen}")
-                        centrality_results['eigenvector'] = [("Calculation Error", f"{e_eigen}")]
-
-                    # --- Calculate Communities (Louvain) ---
-                    print("Calculating Communities (Louvain method)...")
-                    try:
-                        # Use Louvain on the undirected version for standard algorithm application,
-                        # weighting edges appropriately. Consider resolution parameter if needed.
-                        # Louvain works best on undirected graphs, using weights.
-                        communities_generator = nx_community.louvain_communities(G.to_undirected(), weight='weight')
-                        # Convert list of sets to list of sorted lists for display
-                        community_results = [sorted(list(c)) for c in communities_generator]
-                        # Sort communities by size (largest first) for display
-                        community_results.sort(key=len, reverse=True)
-                        print(f"Found {len(community_results)} communities.")
-                    except Exception as e_comm:
-                         print(f"Error calculating communities: {e_comm}")
-                         # Handle error, maybe pass an empty list or error message
-                         community_results = [] # Or pass error message to template
-
-
+            snapshot, status = _network_cache(backend, year).get(_data_version(), wait=NETWORK_ANALYTICS_WAIT)
+            if snapshot is not None:
+                error_message = snapshot['error']
         except Exception as e:
             error_message = f"Error during network analysis: {e}\n{traceback.format_exc()}"
             print(error_message)
 
     return render_template('network_results.html',
-                           results=centrality_results,
-                           communities=community_results, # Pass communities to template
-                           graph_info=graph_info,
+                           results=snapshot['results'] if snapshot else {},
+                           communities=snapshot['communities'] if snapshot else [],
+                           graph_info=snapshot['graph_info'] if snapshot else {},
+                           status=status, year=year, years=_available_years() if db is not None else [],
+                           pending=snapshot is None and error_message is None, job=job,
                            error=error_message)
-    
+
+
+
+def _load_clusters(resolution=1.0, year=None):
+    # (consensus, graph_info, error_message); graph and consensus partition are shared
+    # with /network_analysis (see trade_graph.py). consensus is None while the partition is
+    # computed in the background.
+    resolved = _resolve_year(year)
+    if resolved is None:
+        return None, {}, f"No trade data for {year or 'any year'}."
+    version, G = _graph_for_year(resolved)
+    if G.number_of_nodes() == 0 or G.number_of_edges() == 0:
+        return None, {}, "No suitable trade data found in database to build network (check filters)."
+    graph_info = {'nodes': G.number_of_nodes(), 'edges': G.number_of_edges(), 'year': resolved}
+    # A failed consensus raises: an empty partition would look like a real (and cacheable) answer
+    return _consensus_for_year(version, resolved, resolution=resolution, wait=False), graph_info, None
+
 
 @app.route('/clusters')
 def clusters():
+    db = get_db()
     error_message = None
     community_results = []  # List to hold communities
     graph_info = {}  # Dictionary for basic graph info
+    consensus = None  # Modularity, stability scores, runs (see trade_graph.consensus_communities)
+    job = None
+    pending = False # The shared partition is being computed; the page reloads itself
 
     if db is None:
         error_message = "Database connection not available."
     else:
         try:
-            print("Fetching data for cluster analysis...")
-            # Query to filter data from the database
-            query = {
-                "partner": {"$ne": "World"}, "reporter": {"$ne": "World"},
-                "flow": "Export", "value": {"$gt": 0}
-            }
-            projection = {"_id": 0, "reporter": 1, "partner": 1, "value": 1}
-            trade_data = list(db.trade_records.find(query, projection))
-
-            if not trade_data:
-                error_message = "No suitable trade data found in database to build network (check filters)."
-            else:
-                print(f"Building network graph from {len(trade_data)} export records...")
-                G = nx.DiGraph()  # Directed graph
-                for record in trade_data:
-                    G.add_edge(record['reporter'], record['partner'], weight=record['value'])
-
-                # Ensure the graph is not empty
-                if G.number_of_nodes() == 0 or G.number_of_edges() == 0:
-                    error_message = "Graph could not be built (no valid nodes/edges)."
-                else:
-                    print(f"Graph built with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges.")
-                    graph_info['nodes'] = G.number_of_nodes()
-                    graph_info['edges'] = G.number_of_edges()
-
-                    # --- Calculate Communities (Louvain) ---
-                    print("Calculating Communities (Louvain method)...")
-                    try:
-                        communities_generator = nx_community.louvain_communities(
-                            G.to_undirected(), weight='weight'
-                        )
-                        # Convert list of sets to list of sorted lists for display
-                        community_results = [sorted(list(c)) for c in communities_generator]
-                        # Sort communities by size (largest first)
-                        community_results.sort(key=len, reverse=True)
-                        print(f"Found {len(community_results)} communities.")
-                    except Exception as e_comm:
-                        print(f"Error calculating communities: {e_comm}")
-                        community_results = []  # If there is an error, pass an empty list
-
+            # The default partition is shared with /network_analysis; other parameters run as a job
+            job, error_message = _page_job('clusters', CLUSTER_JOB_ARGS)
+            if job is None and error_message is None:
+                consensus, graph_info, error_message = _load_clusters(year=_selected_year())
+                pending = consensus is None and error_message is None
+            elif job and job['status'] == 'done':
+                consensus, graph_info = job['result'], {**job['result']['graph_info'], 'year': job['year']}
+            elif job and job['status'] == 'failed':
+                error_message = job['error']
+            community_results = consensus['communities'] if consensus else []
         except Exception as e:
             error_message = f"Error during cluster analysis: {e}\n{traceback.format_exc()}"
             print(error_message)
@@ -415,12 +747,314 @@ def clusters():
     return render_template(
         'clusters.html',
         communities=community_results,
+        stability=consensus['stability'] if consensus else [],
+        consensus=consensus,
         graph_info=graph_info,
+        year=graph_info.get('year') or (job and job['year']), years=_available_years() if db is not None else [],
+        job=job, pending=pending,
         error=error_message
     )
 
 
 
+# --- JSON API: same data as the pages above, with ETags tied to the dataset (see http_cache.py) ---
+app.after_request(compress_response)
+
+
+@app.route('/api/country_detail')
+def api_country_detail():
+    db = get_db()
+    selected_country = request.args.get('country_name')
+    if not selected_country:
+        return api_error("No country selected.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+
+    year = _selected_year()
+
+    def build():
+        world_data, partner_data, data_found, trade_year = _load_country_detail(selected_country, year)
+        if not data_found:
+            return {'error': f"No trade data found involving {selected_country} as reporter or partner."}, 404
+        return {'country': selected_country, 'year': trade_year, 'world': world_data, 'partners': partner_data}, 200
+
+    return cached_json(_dataset_etag(), build)
+
+
+# GET /api/country_partners?country_name=A[&sort=partner|export|import|balance][&order=][&flow=export|import]
+#     [&q=name][&limit=50][&after=<cursor>]: one page of A's partner table
+@app.route('/api/country_partners')
+def api_country_partners():
+    db = get_db()
+    selected_country = request.args.get('country_name')
+    if not selected_country:
+        return api_error("No country selected.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    try:
+        sort, descending, flow, search = _partner_filters()
+        after, limit = decode_cursor(request.args.get('after'), partner_cursor(sort)), page_size(request.args.get('limit'))
+    except ValueError as e:
+        return api_error(str(e), 400)
+    year = _selected_year()
+
+    def build():
+        world_data, partner_data, data_found, trade_year = _load_country_detail(selected_country, year)
+        if not data_found:
+            return {'error': f"No trade data found involving {selected_country} as reporter or partner."}, 404
+        rows = partner_rows(partner_data, sort, descending, flow, search)
+        page, next_cursor = page_rows(rows, sort, descending, after, limit)
+        return {'country': selected_country, 'year': trade_year, 'partners': page, 'matching': len(rows),
+                'total': len(partner_data), 'next_cursor': next_cursor}, 200
+
+    try:
+        return cached_json(_dataset_etag(), build)
+    except Exception as e:
+        print(f"Error loading partners of {selected_country}: {e}\n{traceback.format_exc()}")
+        return api_error(f"Error loading partners of {selected_country}: {e}", 500)
+
+
+# GET /country_detail/export?country_name=A&format=csv|json (+ the partner-table filters): streamed
+@app.route('/country_detail/export')
+def export_country_partners():
+    db = get_db()
+    selected_country = request.args.get('country_name')
+    if not selected_country:
+        return api_error("No country selected.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    try:
+        sort, descending, flow, search = _partner_filters()
+        export_format = _export_format()
+    except ValueError as e:
+        return api_error(str(e), 400)
+    try:
+        world_data, partner_data, data_found, trade_year = _load_country_detail(selected_country, _selected_year())
+    except Exception as e:
+        print(f"Error loading partners of {selected_country}: {e}\n{traceback.format_exc()}")
+        return api_error(f"Error loading partners of {selected_country}: {e}", 500)
+    if not data_found:
+        return api_error(f"No trade data found involving {selected_country} as reporter or partner.", 404)
+    rows = partner_rows(partner_data, sort, descending, flow, search)
+    return _export_response(iter(rows), PARTNER_FIELDS, export_format, f"{selected_country}_partners_{trade_year}")
+
+
+@app.route('/api/compare')
+def api_compare():
+    db = get_db()
+    country_A = request.args.get('country_A')
+    country_B = request.args.get('country_B')
+    if not country_A or not country_B:
+        return api_error("Please select two countries to compare.", 400)
+    if country_A == country_B:
+        return api_error("Please select two different countries.", 400)
+    if _invalid_year():
+        return api_error("'year' must be an integer.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    year = _resolve_year(_selected_year())
+    if year is None:
+        return api_error(f"No trade data for {_selected_year() or 'any year'}.", 404)
+
+    def build():
+        trade_data = bilateral_summary(_trade_value_lookup([(country_A, country_B)], year), country_A, country_B)
+        return {'country_A': country_A, 'country_B': country_B, **trade_data}, 200
+
+    return cached_json(_dataset_etag(), build)
+
+
+@app.route('/api/network_analysis')
+def api_network_analysis():
+    db = get_db()
+    backend = request.args.get('backend', CENTRALITY_BACKEND)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    if backend not in CENTRALITY_BACKENDS:
+        return api_error(f"Unknown centrality backend '{backend}'. Choose from: {', '.join(CENTRALITY_BACKENDS)}", 400)
+    year = _resolve_year(_selected_year())
+    if year is None:
+        return api_error(f"No trade data for {_selected_year() or 'any year'}.", 404)
+    snapshot, status = _network_cache(backend, year).get(_data_version(), wait=NETWORK_ANALYTICS_WAIT)
+    if snapshot is None:
+        response = api_error("Network analysis is being computed in the background. Retry shortly.", 503)
+        response.headers['Retry-After'] = '5'
+        return response
+    if snapshot['error']:
+        return api_error(snapshot['error'], 500)
+
+    def build():
+        return {'year': year, 'results': snapshot['results'], 'communities': snapshot['communities'],
+                'graph_info': snapshot['graph_info'], 'status': status}, 200
+
+    # The snapshot (not the live dataset) determines the body, and a stale one is short-lived
+    etag = f"{_dataset_etag()}-{backend}-{year}-s{snapshot['version']}"
+    return cached_json(etag, build, max_age=5 if status.get('stale') else API_MAX_AGE)
+
+
+@app.route('/api/clusters')
+def api_clusters():
+    db = get_db()
+    year = _selected_year()
+    try:
+        resolution = float(request.args.get('resolution', 1.0))
+    except ValueError:
+        return api_error("'resolution' must be a number.", 400)
+    # Only the default partition is computed here (it is shared with /clusters and
+    # /network_analysis); anything else would run a fresh consensus inside the request
+    if 'seed' in request.args or 'weight_threshold' in request.args or resolution != 1.0:
+        return api_error("Seeded, thresholded or non-default-resolution clustering runs as a job: "
+                         "POST /api/jobs {\"kind\": \"clusters\", \"params\": {...}}.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+
+    try:
+        consensus, graph_info, error_message = _load_clusters(year=year)
+    except Exception as e:
+        print(f"Error calculating communities: {e}\n{traceback.format_exc()}")
+        return api_error(f"Error calculating communities: {e}", 500)
+    if error_message:
+        return api_error(error_message, 404)
+    if consensus is None:
+        response = api_error("Clusters are being computed in the background. Retry shortly.", 503)
+        response.headers['Retry-After'] = '5'
+        return response
+
+    def build():
+        return {**consensus, 'graph_info': graph_info}, 200
+
+    # The partition (not the live dataset) determines the body: one served stale after a
+    # change-feed patch (see trade_graph.advance) gets its own, short-lived ETag
+    stale = bool(consensus.get('stale'))
+    etag = f"{_dataset_etag()}-clusters-{graph_info['year']}" + ("-stale" if stale else "")
+    return cached_json(etag, build, max_age=5 if stale else API_MAX_AGE)
+
+
+# POST /api/jobs {"kind": "network_analysis" | "clusters", "year": 2023, "params": {"top_n": 50, ...}}
+# -> 202 and the job (200 when an identical job already finished); poll GET /api/jobs/<job_id>
+@app.route('/api/jobs', methods=['POST'])
+def api_submit_job():
+    db = get_db()
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {}
+    if not isinstance(payload, dict):
+        return api_error("Request body must be a JSON object.", 400)
+    year = payload.get('year')
+    if year is not None and (isinstance(year, bool) or not isinstance(year, int)):
+        return api_error("'year' must be an integer.", 400)
+    if not isinstance(payload.get('params') or {}, dict):
+        return api_error("'params' must be an object.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    try:
+        doc, error_message = _submit_job(payload.get('kind'), payload.get('params'), year)
+    except Exception as e:
+        print(f"Error submitting job: {e}\n{traceback.format_exc()}")
+        return api_error(f"Error submitting job: {e}", 500)
+    if error_message:
+        return api_error(error_message, 404 if error_message.startswith("No trade data") else 400)
+    response = jsonify(public_job(doc))
+    response.status_code = 200 if doc['status'] == 'done' else 202
+    response.headers['Location'] = url_for('api_job', job_id=doc['_id'])
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    db = get_db()
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    doc = job_manager.get(job_id)
+    if doc is None:
+        return api_error(f"No job {job_id}.", 404)
+    if doc['status'] == 'done':
+        return cached_json(f"job-{job_id}", lambda: (public_job(doc), 200)) # Finished results never change
+    response = jsonify(public_job(doc))
+    if doc['status'] in ('queued', 'running'):
+        response.headers['Retry-After'] = '2'
+    response.cache_control.no_store = True
+    return response
+
+
+# GET /api/trend?country=A[&partner=B][&year_from=2000][&year_to=2024]
+# Without partner: A's World totals per year; with partner: the A <-> B flows per year
+@app.route('/api/trend')
+def api_trend():
+    db = get_db()
+    country = request.args.get('country')
+    partner = request.args.get('partner')
+    year_from = request.args.get('year_from', None, type=int)
+    year_to = request.args.get('year_to', None, type=int)
+    if not country:
+        return api_error("No country selected.", 400)
+    if partner == country:
+        return api_error("Please select two different countries.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+
+    def build():
+        trend = _load_trend(country, partner, year_from, year_to)
+        if not trend:
+            return {'error': f"No trade data found for {country}" + (f" and {partner}." if partner else ".")}, 404
+        body = {'country': country, 'year_from': trend[0]['year'], 'year_to': trend[-1]['year'], 'trend': trend}
+        if partner:
+            body['partner'] = partner
+        return body, 200
+
+    return cached_json(_dataset_etag(), build)
+
+
+# GET /api/rankings[?by=partners|countries][&order=surplus|deficit][&country=A][&year=2024][&limit=20]
+# Largest trade surpluses/deficits: countries by World balance, or country-partner pairs
+# (only A's partners when country is given)
+@app.route('/api/rankings')
+def api_rankings():
+    db = get_db()
+    by = request.args.get('by', 'partners')
+    order = request.args.get('order', 'surplus')
+    country = request.args.get('country') or None
+    limit = request.args.get('limit', 20, type=int)
+    if by not in ('partners', 'countries') or order not in ('surplus', 'deficit'):
+        return api_error("'by' must be partners or countries and 'order' surplus or deficit.", 400)
+    if country and by == 'countries':
+        return api_error("'country' only applies to by=partners.", 400)
+    if not 1 <= limit <= RANKING_MAX_LIMIT:
+        return api_error(f"'limit' must be between 1 and {RANKING_MAX_LIMIT}.", 400)
+    if db is None:
+        return api_error("Database connection not available.", 503)
+    year = _selected_year()
+    resolved = _resolve_year(year)
+    if resolved is None:
+        return api_error(f"No trade data for {year or 'any year'}.", 404)
+
+    def build():
+        rankings = _load_rankings(by, order, limit, resolved, country)
+        if rankings is None:
+            return {'error': "Country summaries have not been built yet: run ingest.py or POST /reload_data."}, 503
+        body = {'by': by, 'order': order, 'year': resolved, 'rankings': rankings}
+        if country:
+            body['country'] = country
+        return body, 200
+
+    return cached_json(_dataset_etag(), build)
+
+
+@app.template_global()
+def year_url(year):
+    # The current page's URL with ?year= replaced (used by the year links in the templates)
+    args = request.args.to_dict()
+    args['year'] = year
+    args.pop('after', None) # Page cursors don't carry over between years
+    return url_for(request.endpoint, **args)
+
+
+# Prometheus scrape target: request, query, graph, algorithm and template timings (see metrics.py)
+@app.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8', 'Cache-Control': 'no-store'}
+
+
 # Run the app if this script is executed directly
 if __name__ == '__main__':
     print("Starting Flask application...")
@@ -0,0 +1,265 @@
+# bench.py
+# Latency/throughput benchmark for the app's routes against a seeded stand-in database:
+# mongomock by default, or a real MongoDB (a separate database, dropped and re-seeded).
+# The 2024 CSV is scaled up to N synthetic years (10x / 100x rows) so multi-year
+# behaviour is exercised, then every route is driven through the Flask test client
+# and through concurrent HTTP clients against a local threaded server.
+#
+#   python bench.py                                   # 1x, mongomock, trade matrix on
+#   python bench.py --scale 10 --concurrency 16 --json bench_10x.json
+#   python bench.py --scale 10 --baseline bench_10x.json   # exit 1 on p95 regressions
+#   python bench.py --no-matrix --mongo-uri mongodb://localhost:27017 --database trade_bench
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+import pymongo
+from ingest import detect_encoding, iter_csv_rows, iter_chunks, write_summaries
+from trade_queries import ensure_indexes
+
+DEFAULT_CSV = 'trade_data_global_2024.csv'
+ROUTES = ('country_detail', 'compare', 'network_analysis', 'clusters',
+          'api_country_detail', 'api_compare', 'api_trend', 'api_rankings')
+DEFAULT_ROUTES = ('country_detail', 'compare', 'network_analysis', 'clusters')
+PERCENTILES = (50, 95, 99)
+
+
+# --- Seeding ---
+def scaled_records(path, scale, seed=0, growth=0.03):
+    # The source rows for their own year, then `scale - 1` earlier synthetic years:
+    # values shrink by `growth` per year with +/-10% noise, so years are distinct but plausible
+    rng = random.Random(seed)
+    stats = {'skipped': 0}
+    base = [record for chunk in iter_chunks(iter_csv_rows(path, detect_encoding(path)), 10000, stats) for record in chunk]
+    for offset in range(scale):
+        factor = (1 - growth) ** offset
+        for record in base:
+            value = record['value'] * factor * (rng.uniform(0.9, 1.1) if offset else 1.0)
+            yield dict(record, year=record['year'] - offset, value=value)
+
+
+def seed_database(db, path, scale, chunk_size=10000):
+    started = time.perf_counter()
+    db.trade_records.drop()
+    chunk, rows = [], 0
+    for record in scaled_records(path, scale):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            db.trade_records.insert_many(chunk, ordered=False)
+            rows += len(chunk)
+            chunk = []
+    if chunk:
+        db.trade_records.insert_many(chunk, ordered=False)
+        rows += len(chunk)
+    ensure_indexes(db)
+    print(f"Seeded {rows:,} rows ({scale}x) in {time.perf_counter() - started:.1f}s.")
+    write_summaries(db)
+    return rows
+
+
+def open_database(args):
+    if args.mongo_uri:
+        client = pymongo.MongoClient(args.mongo_uri)
+        return client, client[args.database]
+    import mongomock # Optional: pip install mongomock
+    client = mongomock.MongoClient()
+    return client, client[args.database]
+
+
+# --- Request mix ---
+def url_factory(route, countries, years, latest, rng):
+    # A function returning the next URL for `route`; countries/years are drawn at random,
+    # while the graph routes stay on the latest year (their steady state is a warm cache)
+    def pick():
+        return rng.choice(countries)
+
+    def pair():
+        return rng.sample(countries, 2)
+
+    def query(**params):
+        return urllib.parse.urlencode(params)
+
+    return {
+        'country_detail': lambda: '/country_detail?' + query(country_name=pick(), year=rng.choice(years)),
+        'compare': lambda: '/compare?' + query(**dict(zip(('country_A', 'country_B'), pair())), year=rng.choice(years)),
+        'network_analysis': lambda: '/network_analysis?' + query(year=latest),
+        'clusters': lambda: '/clusters?' + query(year=latest),
+        'api_country_detail': lambda: '/api/country_detail?' + query(country_name=pick(), year=rng.choice(years)),
+        'api_compare': lambda: '/api/compare?' + query(**dict(zip(('country_A', 'country_B'), pair())), year=rng.choice(years)),
+        'api_trend': lambda: '/api/trend?' + query(country=pick()),
+        'api_rankings': lambda: '/api/rankings?' + query(by=rng.choice(('partners', 'countries')),
+                                                         order=rng.choice(('surplus', 'deficit')), year=rng.choice(years)),
+    }[route]
+
+
+def summarize(latencies, statuses, wall_seconds):
+    latencies_ms = np.asarray(latencies) * 1000.0
+    summary = {'requests': len(latencies), 'ok': sum(1 for s in statuses if s == 200),
+               'errors': sum(1 for s in statuses if s != 200),
+               'throughput': round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0,
+               'mean_ms': round(float(latencies_ms.mean()), 2) if len(latencies_ms) else 0.0}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = round(float(np.percentile(latencies_ms, p)), 2) if len(latencies_ms) else 0.0
+    return summary
+
+
+# --- Phase 1: Flask test client, one request at a time ---
+def run_test_client(app, route, next_url, requests):
+    client = app.test_client()
+    latencies, statuses = [], []
+    started = time.perf_counter()
+    for _ in range(requests):
+        url = next_url()
+        t0 = time.perf_counter()
+        response = client.get(url)
+        response.get_data()
+        latencies.append(time.perf_counter() - t0)
+        statuses.append(response.status_code)
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+# --- Phase 2: concurrent HTTP clients against a local threaded server ---
+def start_server(app):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # No per-request access log lines
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _fetch(base_url, url, timeout):
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(base_url + url, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = 0 # Connection error / timeout
+    return time.perf_counter() - t0, status
+
+
+def run_http(base_url, route, next_url, requests, concurrency, timeout=60):
+    urls = [next_url() for _ in range(requests)] # Drawn up front: the RNG isn't shared across threads
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda url: _fetch(base_url, url, timeout), urls))
+    wall = time.perf_counter() - started
+    return summarize([r[0] for r in results], [r[1] for r in results], wall)
+
+
+# --- Reporting ---
+def print_table(phase, results):
+    print(f"\n{phase}")
+    print(f"{'route':<22}{'n':>6}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for route, r in results.items():
+        print(f"{route:<22}{r['requests']:>6}{r['errors']:>8}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['throughput']:>10.2f}")
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    # p95 more than `tolerance` (fraction) above the baseline's counts as a regression
+    regressions = []
+    for phase, results in report['results'].items():
+        for route, r in results.items():
+            before = baseline.get('results', {}).get(phase, {}).get(route)
+            if not before or not before.get('p95_ms'):
+                continue
+            change = r['p95_ms'] / before['p95_ms'] - 1
+            flag = "REGRESSION" if change > tolerance else ""
+            print(f"  {phase:<12}{route:<22}p95 {before['p95_ms']:>9.2f} -> {r['p95_ms']:>9.2f} ms ({change:+.0%}) {flag}")
+            if flag:
+                regressions.append((phase, route))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the trade app's routes against a seeded stand-in database.")
+    parser.add_argument('--csv', default=DEFAULT_CSV, help="Source rows (one year); scaled up with synthetic years")
+    parser.add_argument('--scale', type=int, default=1, help="Number of years to generate (10 and 100 give 10x/100x rows)")
+    parser.add_argument('--mongo-uri', default=None, help="Benchmark a real MongoDB instead of mongomock")
+    parser.add_argument('--database', default='trade_bench', help="Dropped and re-seeded; don't point this at real data")
+    parser.add_argument('--no-matrix', action='store_true', help="Serve from MongoDB per request (USE_TRADE_MATRIX=0)")
+    parser.add_argument('--routes', nargs='+', default=list(DEFAULT_ROUTES), choices=ROUTES)
+    parser.add_argument('--requests', type=int, default=200, help="Measured requests per route and phase")
+    parser.add_argument('--warmup', type=int, default=5, help="Unmeasured requests per route first")
+    parser.add_argument('--concurrency', type=int, default=8, help="Parallel HTTP clients (0 skips the HTTP phase)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help="Write the report here (usable later as --baseline)")
+    parser.add_argument('--baseline', default=None, help="Earlier --json report to compare p95 latencies against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed p95 slowdown vs. the baseline (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    client, db = open_database(args)
+    rows = seed_database(db, args.csv, args.scale)
+
+    import mongo
+    mongo.set_db(db, client)
+    import app as trade_app # Imported after set_db so nothing tries to reach MONGO_URI
+    trade_app.USE_TRADE_MATRIX = not args.no_matrix
+    trade_app.NETWORK_ANALYTICS_WAIT = 600 # Warm-up waits for the first snapshot instead of measuring "pending"
+    app = trade_app.app
+    app.logger.disabled = True
+
+    countries = trade_app.fetch_distinct_countries(db)
+    years = trade_app.fetch_years(db)
+    latest = years[-1]
+    rng = random.Random(args.seed)
+    next_urls = {route: url_factory(route, countries, years, latest, rng) for route in args.routes}
+
+    print(f"Warming up ({args.warmup} requests per route)...")
+    warm_client = app.test_client()
+    for route, next_url in next_urls.items():
+        for _ in range(args.warmup):
+            warm_client.get(next_url()).get_data()
+
+    report = {'meta': {'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                       'rows': rows, 'scale': args.scale, 'years': [years[0], latest],
+                       'countries': len(countries), 'trade_matrix': not args.no_matrix,
+                       'database': 'mongodb' if args.mongo_uri else 'mongomock',
+                       'requests': args.requests, 'concurrency': args.concurrency},
+              'results': {}}
+
+    print(f"Measuring with the Flask test client ({args.requests} requests per route)...")
+    report['results']['test_client'] = {route: run_test_client(app, route, next_url, args.requests)
+                                        for route, next_url in next_urls.items()}
+    print_table("test client (sequential)", report['results']['test_client'])
+
+    if args.concurrency > 0:
+        server, base_url = start_server(app)
+        print(f"\nMeasuring over HTTP at {base_url} ({args.concurrency} concurrent clients)...")
+        try:
+            report['results']['http'] = {route: run_http(base_url, route, next_url, args.requests, args.concurrency)
+                                         for route, next_url in next_urls.items()}
+        finally:
+            server.shutdown()
+        print_table(f"http ({args.concurrency} concurrent clients)", report['results']['http'])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.json}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for key in ('scale', 'trade_matrix', 'database', 'concurrency'):
+            if baseline.get('meta', {}).get(key) != report['meta'][key]:
+                print(f"  Warning: baseline was run with {key}={baseline.get('meta', {}).get(key)!r}, this run with {report['meta'][key]!r}.")
+        if compare_to_baseline(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
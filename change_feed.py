@@ -0,0 +1,173 @@
+# change_feed.py
+# Follows writes to db.trade_records so a revised figure patches the shared trade matrix,
+# graphs and cheap metrics in place instead of a full reload (see app._apply_trade_changes).
+# Uses a MongoDB change stream when the server has one (replica sets / Atlas), otherwise
+# polls the updated_at watermark that ingest.py stamps on every upserted record.
+# Every process follows the feed and patches its own memory, but only the holder of the
+# summary-writer lease (in trade_meta) writes the shared country_summaries collection.
+# Bulk loads and POST /reload_data bump a shared data version (trade_meta) instead; every
+# process follows it and reloads. Polling can't see deletes: after deleting records, POST
+# /reload_data. With TRADE_CHANGE_FEED=0 only the data version is followed.
+import os
+import socket
+import threading
+import time
+import uuid
+from trade_queries import latest_update, changes_since, acquire_lease, shared_data_version
+from metrics import debug
+
+CHANGE_FEED = os.environ.get("TRADE_CHANGE_FEED", "1") != "0"
+POLL_SECONDS = float(os.environ.get("TRADE_CHANGE_POLL_SECONDS", "5"))
+BATCH_LIMIT = 10000 # A bigger batch than this (a whole re-ingest) is cheaper as one full reload
+RECORD_FIELDS = ('year', 'reporter', 'partner', 'flow', 'value')
+WRITER_LEASE = 'summary_writer'
+WRITER_LEASE_SECONDS = max(30.0, 6 * POLL_SECONDS) # A dead writer's lease is taken over after this
+
+
+class ChangeFeed:
+    def __init__(self, get_db, apply_changes, reload):
+        # apply_changes(records, write_shared) patches; reload(write_shared) rebuilds everything
+        # from the collection. write_shared: whether this process also updates country_summaries.
+        self._get_db = get_db
+        self._apply_changes = apply_changes
+        self._reload = reload
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The thread doesn't survive fork(); each process starts its own on first request
+        self._lock = threading.Lock()
+        self._pid = None
+        self._streaming = False # A change stream opened once; errors after that are retried, not a fallback
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._writer_until = 0.0 # monotonic() up to which this process is known to hold the writer lease
+        self._version = None # Shared data version this process last (re)loaded at
+        self._version_checked = 0.0
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="trade-change-feed", daemon=True).start()
+
+    def _run(self):
+        while True:
+            db = self._get_db()
+            if db is None:
+                time.sleep(POLL_SECONDS)
+                continue
+            if not CHANGE_FEED:
+                self._follow_reloads(db)
+                return
+            try:
+                self._watch(db)
+            except Exception as e:
+                if not self._streaming: # Standalone server, or a stand-in without watch()
+                    print(f"No change stream on trade_records ({e}); polling every {POLL_SECONDS:g}s instead.")
+                    self._poll(db)
+                    return
+                print(f"Change stream on trade_records failed, reopening (changes meanwhile need /reload_data): {e}")
+                time.sleep(POLL_SECONDS)
+
+    # --- Change streams ---
+    def _watch(self, db):
+        with db.trade_records.watch(full_document='updateLookup') as stream:
+            self._streaming = True
+            debug("Following trade_records through a change stream.")
+            while stream.alive:
+                self._reload_requested(db)
+                records, reload = [], False
+                change = stream.try_next()
+                while change is not None and len(records) < BATCH_LIMIT: # Drain what has piled up into one patch
+                    if change['operationType'] in ('insert', 'update', 'replace') and change.get('fullDocument'):
+                        records.append({field: change['fullDocument'].get(field) for field in RECORD_FIELDS})
+                    elif change['operationType'] in ('delete', 'drop', 'rename', 'dropDatabase', 'invalidate'):
+                        reload = True
+                    change = stream.try_next()
+                if reload or len(records) >= BATCH_LIMIT:
+                    self._reload(self._writer(db))
+                elif records:
+                    self._apply_changes(records, self._writer(db))
+                else:
+                    time.sleep(0.2)
+
+    # --- Polling fallback ---
+    def _poll(self, db):
+        # Records sharing the watermark timestamp (one ingest run stamps them all alike) are
+        # re-read each poll and skipped once applied, so a run still in progress isn't missed.
+        # After a (re)load everything up to the watermark is already in memory, so ties are skipped.
+        watermark, seen, inclusive = latest_update(db), set(), False
+        while True:
+            time.sleep(POLL_SECONDS)
+            try:
+                if self._reload_requested(db):
+                    watermark, seen, inclusive = latest_update(db), set(), False
+                    continue
+                batch = changes_since(db, watermark, limit=BATCH_LIMIT, inclusive=inclusive)
+                if len(batch) >= BATCH_LIMIT:
+                    self._reload(self._writer(db))
+                    watermark, seen, inclusive = latest_update(db), set(), False
+                    continue
+                fresh = [r for r in batch if _record_key(r) not in seen]
+                if not fresh:
+                    continue
+                if fresh[-1]['updated_at'] != watermark:
+                    watermark, seen, inclusive = fresh[-1]['updated_at'], set(), True
+                seen.update(_record_key(r) for r in batch if r['updated_at'] == watermark)
+                self._apply_changes([{field: r.get(field) for field in RECORD_FIELDS} for r in fresh], self._writer(db))
+            except Exception as e:
+                print(f"Error polling trade_records changes: {e}")
+
+    # --- Reloads requested through the shared data version ---
+    def mark_reloaded(self, version):
+        # This process has just reloaded at shared data `version` (see app.reload_data)
+        self._version = version
+
+    def _reload_requested(self, db):
+        # Reloads (without the shared writes: whoever bumped the version did those) when
+        # ingest.py or /reload_data in any process bumped the shared data version. Checked at
+        # most every POLL_SECONDS; the first check only records where this process starts.
+        if time.monotonic() < self._version_checked + POLL_SECONDS:
+            return False
+        self._version_checked = time.monotonic()
+        version = shared_data_version(db)
+        if self._version is None or version == self._version:
+            self._version = version
+            return False
+        print(f"Shared data version moved to {version}; reloading.")
+        self._version = version
+        self._reload(False)
+        return True
+
+    def _follow_reloads(self, db):
+        while True:
+            time.sleep(POLL_SECONDS)
+            try:
+                self._reload_requested(db)
+            except Exception as e:
+                print(f"Error checking the shared data version: {e}")
+
+    # --- Single writer for shared collections ---
+    def _writer(self, db):
+        # Whether this process writes country_summaries for the changes at hand. The lease is
+        # renewed well before it runs out, so a live writer keeps it and the others skip.
+        if time.monotonic() < self._writer_until:
+            return True
+        try:
+            if acquire_lease(db, WRITER_LEASE, self._owner, WRITER_LEASE_SECONDS):
+                if not self._writer_until:
+                    debug(f"This process ({self._owner}) now writes country_summaries.")
+                self._writer_until = time.monotonic() + WRITER_LEASE_SECONDS / 3
+                return True
+        except Exception as e:
+            print(f"Error acquiring the {WRITER_LEASE} lease: {e}")
+        self._writer_until = 0.0
+        return False
+
+
+def _record_key(record):
+    return tuple(record.get(field) for field in RECORD_FIELDS)
@@ -0,0 +1,63 @@
+# http_cache.py
+# Helpers for the /api/... JSON routes: ETags tied to the dataset, conditional
+# GETs answered with 304, Cache-Control headers, and gzip/brotli compression.
+import gzip
+from flask import request, jsonify, make_response
+
+try:
+    import brotli # Optional: pip install brotli
+except ImportError:
+    brotli = None
+
+API_MAX_AGE = 300 # Seconds browsers/CDNs may reuse a response before revalidating
+MIN_COMPRESS_SIZE = 512 # Bytes; smaller bodies aren't worth compressing
+
+
+def _set_cache_headers(response, etag, max_age):
+    response.set_etag(etag, weak=True) # Weak: the compressed and plain bodies differ byte-wise
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.stale_while_revalidate = max_age
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def cached_json(etag, build, max_age=API_MAX_AGE):
+    # build() -> (payload, status). Skipped entirely when the client already holds `etag`.
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return _set_cache_headers(make_response('', 304), etag, max_age)
+    payload, status = build()
+    response = jsonify(payload)
+    response.status_code = status
+    if status == 200 and etag is not None:
+        return _set_cache_headers(response, etag, max_age)
+    response.cache_control.no_store = True
+    return response
+
+
+def api_error(message, status):
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.cache_control.no_store = True
+    return response
+
+
+def compress_response(response):
+    # after_request hook: brotli when available and accepted, else gzip
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding, compress = 'br', lambda data: brotli.compress(data, quality=5)
+    elif accepted['gzip']:
+        encoding, compress = 'gzip', lambda data: gzip.compress(data, compresslevel=6)
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(compress(data))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,177 @@
+# ingest.py
+# Bulk loader for trade_records: streams a Comtrade-style CSV (or Parquet) file in
+# chunks and upserts it into MongoDB, keyed on (year, reporter, partner, flow).
+#
+#   python ingest.py trade_data_global_2024.csv
+#   python ingest.py trade_2000_2024.csv --chunk-size 20000 --snapshot trade_matrix.npz
+#
+# Afterwards the country_summaries view (see trade_queries.py) is rebuilt in one pass, and
+# the shared data version is bumped so running app servers reload.
+import argparse
+import csv
+import os
+import sys
+import time
+from datetime import datetime, timezone
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from trade_queries import ensure_indexes, write_country_summaries, bump_data_version
+
+# Source column -> trade_records field (already-mapped column names are accepted too)
+COLUMN_MAP = {'period': 'year', 'reporterDesc': 'reporter', 'partnerDesc': 'partner', 'flowDesc': 'flow', 'primaryValue': 'value'}
+FIELDS = ('year', 'reporter', 'partner', 'flow', 'value')
+
+
+def detect_encoding(path, sample_size=1 << 20):
+    # Comtrade exports are often cp1252 (e.g. "Türkiye"); fall back to it when the sample isn't UTF-8
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+    try:
+        sample.decode('utf-8-sig')
+        return 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        if e.start >= len(sample) - 4: # Sample cut a multi-byte character in half
+            return 'utf-8-sig'
+        return 'cp1252'
+
+
+def _to_record(row):
+    record = {COLUMN_MAP.get(column, column): value for column, value in row.items()}
+    try:
+        return {
+            'year': int(float(record['year'])),
+            'reporter': record['reporter'].strip(),
+            'partner': record['partner'].strip(),
+            'flow': record['flow'].strip(),
+            'value': float(record['value']),
+        }
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+
+
+def iter_csv_rows(path, encoding):
+    with open(path, newline='', encoding=encoding) as f:
+        yield from csv.DictReader(f)
+
+
+def iter_parquet_rows(path, batch_size):
+    import pyarrow.parquet as pq # Optional dependency, only for Parquet input
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+def iter_chunks(rows, chunk_size, stats):
+    chunk = []
+    for row in rows:
+        record = _to_record(row)
+        if record is None:
+            stats['skipped'] += 1
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_chunk(collection, chunk, loaded_at):
+    operations = [
+        UpdateOne({'year': r['year'], 'reporter': r['reporter'], 'partner': r['partner'], 'flow': r['flow']},
+                  {'$set': {'value': r['value'], 'updated_at': loaded_at}},
+                  upsert=True)
+        for r in chunk
+    ]
+    # Unordered: the server may apply the batch in parallel and keeps going past individual
+    # errors, which PyMongo then raises together once the batch is done.
+    # Returns (upserted, modified, write errors).
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+        return result.upserted_count, result.modified_count, []
+    except BulkWriteError as e:
+        details = e.details
+        return details.get('nUpserted', 0), details.get('nModified', 0), details.get('writeErrors', [])
+
+
+def ingest(db, path, chunk_size=10000, encoding=None, progress_every=100000):
+    collection = db.trade_records
+    print("Ensuring indexes on trade_records...")
+    ensure_indexes(db) # Includes the unique (year, reporter, partner, flow) upsert key
+
+    if path.endswith('.parquet'):
+        rows = iter_parquet_rows(path, chunk_size)
+    else:
+        encoding = encoding or detect_encoding(path)
+        print(f"Reading {path} ({encoding})...")
+        rows = iter_csv_rows(path, encoding)
+
+    stats = {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    started = time.perf_counter()
+    next_report = progress_every
+    for chunk in iter_chunks(rows, chunk_size, stats):
+        upserted, modified, errors = upsert_chunk(collection, chunk, datetime.now(timezone.utc))
+        stats['rows'] += len(chunk)
+        stats['inserted'] += upserted
+        stats['updated'] += modified
+        if errors:
+            stats['failed'] += len(errors)
+            print(f"  {len(errors):,} rows in this batch failed, e.g.: {errors[0].get('errmsg')}")
+        if stats['rows'] >= next_report:
+            elapsed = time.perf_counter() - started
+            print(f"  {stats['rows']:,} rows ({stats['rows'] / elapsed:,.0f} rows/sec)")
+            next_report += progress_every
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def write_snapshot(db, path, matrix=None):
+    # Compact copy of the collection for the in-process cache (see TRADE_MATRIX_SNAPSHOT in trade_matrix.py)
+    from trade_matrix import TradeMatrix
+    if path.endswith('.parquet'):
+        import pandas as pd # Optional dependency, only for Parquet snapshots
+        projection = {'_id': 0, 'year': 1, 'reporter': 1, 'partner': 1, 'flow': 1, 'value': 1}
+        pd.DataFrame(list(db.trade_records.find({}, projection)), columns=list(FIELDS)).to_parquet(path, index=False)
+    else:
+        (matrix or TradeMatrix.from_collection(db.trade_records)).save_npz(path)
+    print(f"Wrote snapshot {path} ({os.path.getsize(path):,} bytes).")
+
+
+def write_summaries(db):
+    # Rebuild country_summaries from one pass over trade_records; returns the matrix it used
+    from trade_matrix import TradeMatrix
+    started = time.perf_counter()
+    matrix = TradeMatrix.from_collection(db.trade_records)
+    written = write_country_summaries(db, matrix.summary_documents(), matrix.years)
+    print(f"Rebuilt country_summaries: {written:,} documents in {time.perf_counter() - started:.1f}s.")
+    return matrix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load a trade data file into MongoDB trade_records.")
+    parser.add_argument('path', help="CSV (period, reporterDesc, partnerDesc, flowDesc, primaryValue) or Parquet file")
+    parser.add_argument('--mongo-uri', default=os.environ.get("MONGO_URI"), help="Defaults to $MONGO_URI")
+    parser.add_argument('--database', default=os.environ.get("MONGO_DB", "trade_db"), help="Defaults to $MONGO_DB, else trade_db")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Rows per bulk_write batch")
+    parser.add_argument('--encoding', default=None, help="CSV encoding (detected when omitted)")
+    parser.add_argument('--snapshot', default=None, help="Also write a .npz or .parquet snapshot for the app's trade matrix")
+    parser.add_argument('--no-summaries', action='store_true', help="Skip rebuilding the country_summaries view")
+    args = parser.parse_args(argv)
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    db = client[args.database]
+    stats = ingest(db, args.path, chunk_size=args.chunk_size, encoding=args.encoding)
+    rate = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+    print(f"Loaded {stats['rows']:,} rows in {stats['seconds']:.1f}s ({rate:,.0f} rows/sec): "
+          f"{stats['inserted']:,} inserted, {stats['updated']:,} updated, {stats['skipped']:,} skipped, {stats['failed']:,} failed.")
+    matrix = None if args.no_summaries else write_summaries(db)
+    if args.snapshot:
+        write_snapshot(db, args.snapshot, matrix)
+    version = bump_data_version(db)
+    print(f"Data version bumped to {version}: running app servers reload within a few seconds.")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# jobs.py
+# Analytics with custom parameters (top_n, weight threshold, Louvain resolution/seed)
+# run as background jobs in the shared process pool (process_pool.py), never inside a request. Job state lives in
+# MongoDB (analysis_jobs) so any gunicorn worker can answer a poll; the job id is a
+# hash of (dataset, kind, parameters), so identical submissions share one job and a
+# finished job's stored result is returned straight away.
+import hashlib
+import json
+import math
+import os
+import threading
+from datetime import datetime, timezone
+import pymongo
+from centrality import METRICS, BACKENDS
+from trade_graph import CONSENSUS_RUNS
+from metrics import debug
+from process_pool import shared_pool, progress_queue
+
+JOB_STALE_SECONDS = 600 # A queued/running job silent this long (e.g. its worker died) may be resubmitted
+JOB_TTL_SECONDS = 7 * 24 * 3600 # Finished jobs are dropped by MongoDB after a week
+MAX_TOP_N = 500
+MAX_RUNS = 256 # Seeded Louvain runs behind one consensus partition
+
+# kind -> default parameters (anything else submitted is rejected)
+JOB_KINDS = {
+    'network_analysis': {'backend': 'networkx', 'top_n': 20, 'weight_threshold': 0.0, 'resolution': 1.0, 'seed': 0, 'runs': CONSENSUS_RUNS},
+    'clusters': {'weight_threshold': 0.0, 'resolution': 1.0, 'seed': 0, 'runs': CONSENSUS_RUNS},
+}
+ACTIVE = ('queued', 'running')
+
+
+def normalize_params(kind, raw):
+    # (params, error): defaults filled in, types checked, so equal requests hash equally
+    if kind not in JOB_KINDS:
+        return None, f"Unknown job kind '{kind}'. Choose from: {', '.join(JOB_KINDS)}"
+    raw = raw or {}
+    unknown = set(raw) - set(JOB_KINDS[kind])
+    if unknown:
+        return None, f"Unknown parameter(s) for {kind}: {', '.join(sorted(unknown))}"
+    params = dict(JOB_KINDS[kind])
+    try:
+        for key, value in raw.items():
+            if value is None: # null: the default
+                continue
+            if key == 'backend':
+                params[key] = value
+            elif key in ('top_n', 'seed', 'runs'):
+                params[key] = int(value)
+            else:
+                params[key] = float(value)
+                if not math.isfinite(params[key]):
+                    raise ValueError(value)
+    except (TypeError, ValueError):
+        return None, f"Invalid value for '{key}'."
+    if 'backend' in params and params['backend'] not in BACKENDS:
+        return None, f"Unknown centrality backend '{params['backend']}'. Choose from: {', '.join(BACKENDS)}"
+    if 'top_n' in params and not 1 <= params['top_n'] <= MAX_TOP_N:
+        return None, f"'top_n' must be between 1 and {MAX_TOP_N}."
+    if not 1 <= params['runs'] <= MAX_RUNS:
+        return None, f"'runs' must be between 1 and {MAX_RUNS}."
+    if params['weight_threshold'] < 0 or params['resolution'] <= 0:
+        return None, "'weight_threshold' must be >= 0 and 'resolution' > 0."
+    return params, None
+
+
+def job_id_for(kind, data_key, year, params):
+    payload = json.dumps({'kind': kind, 'data': data_key, 'year': year, 'params': params}, sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=12).hexdigest()
+
+
+# --- Worker process side ---
+def _report(job_id, done, total, message):
+    progress_queue().put((job_id, round(done / total, 3), message))
+
+
+def run_job(job_id, kind, edges, params):
+    # Runs in a pool process: edges is a list of (reporter, partner, value) for the job's year
+    from network_analytics import compute_network_snapshot
+    from trade_graph import build_export_graph, consensus_communities
+    _report(job_id, 0, 1, "Building graph")
+    G = build_export_graph((r, p, v) for r, p, v in edges if v > params['weight_threshold'])
+    if G.number_of_nodes() == 0 or G.number_of_edges() == 0:
+        raise ValueError("No export flows above the weight threshold.")
+    graph_info = {'nodes': G.number_of_nodes(), 'edges': G.number_of_edges(), 'weight_threshold': params['weight_threshold']}
+    # Already inside a pool process, so the consensus runs serially here
+    consensus = lambda: consensus_communities(G.to_undirected(), runs=params['runs'], resolution=params['resolution'],
+                                              seed=params['seed'], workers=1)
+    if kind == 'clusters':
+        _report(job_id, 1, 2, f"Running {params['runs']} community detections")
+        return {**consensus(), 'graph_info': graph_info}
+    steps = len(METRICS) + 1
+    snapshot = compute_network_snapshot(G, lambda: consensus()['communities'], top_n=params['top_n'], backend=params['backend'],
+                                        progress=lambda done, message: _report(job_id, done, steps, message))
+    return {'results': snapshot['results'], 'communities': snapshot['communities'],
+            'graph_info': {**graph_info, **snapshot['graph_info']}}
+
+
+# --- App process side ---
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def public_job(doc):
+    # The job document as the API returns it
+    job = {'job_id': doc['_id'], 'kind': doc['kind'], 'year': doc.get('year'), 'params': doc['params'],
+           'status': doc['status'], 'progress': doc.get('progress', 0.0), 'message': doc.get('message'),
+           'submitted_at': doc['submitted_at'].isoformat(timespec='seconds')}
+    for key in ('started_at', 'finished_at'):
+        if doc.get(key):
+            job[key] = doc[key].isoformat(timespec='seconds')
+    if doc.get('duration_seconds') is not None:
+        job['duration_seconds'] = doc['duration_seconds']
+    if doc['status'] == 'done':
+        job['result'] = doc.get('result')
+    if doc['status'] == 'failed':
+        job['error'] = doc.get('error')
+    return job
+
+
+class JobManager:
+    def __init__(self, get_db):
+        self._get_db = get_db
+        self._indexed = False
+        self._lock = threading.Lock()
+        self._listener_pid = None # The progress thread doesn't survive fork(); each process starts its own
+
+    def _pool(self):
+        pool = shared_pool()
+        with self._lock:
+            if self._listener_pid != os.getpid():
+                self._listener_pid = os.getpid()
+                threading.Thread(target=self._listen, args=(progress_queue(),), name="analysis-job-progress", daemon=True).start()
+        return pool
+
+    def _collection(self, db):
+        collection = db.analysis_jobs
+        if not self._indexed:
+            collection.create_index('submitted_at', name='job_ttl', expireAfterSeconds=JOB_TTL_SECONDS)
+            self._indexed = True
+        return collection
+
+    def get(self, job_id):
+        db = self._get_db()
+        return self._collection(db).find_one({'_id': job_id}) if db is not None else None
+
+    def submit(self, kind, params, data_key, year, load_edges):
+        # Returns the job document: an existing one for identical submissions, else a new queued job
+        db = self._get_db()
+        collection = self._collection(db)
+        job_id = job_id_for(kind, data_key, year, params)
+        doc = {'_id': job_id, 'kind': kind, 'year': year, 'params': params, 'data_key': data_key,
+               'status': 'queued', 'progress': 0.0, 'message': "Queued", 'submitted_at': _now(), 'heartbeat': _now()}
+        try:
+            collection.insert_one(doc)
+        except pymongo.errors.DuplicateKeyError:
+            existing = collection.find_one({'_id': job_id})
+            if existing is not None and not self._needs_rerun(existing):
+                return existing
+            # Failed or abandoned: take it over, unless another worker just did
+            stale = {'_id': job_id, 'status': existing['status'], 'heartbeat': existing.get('heartbeat')} if existing else {'_id': job_id}
+            if collection.find_one_and_replace(stale, doc) is None:
+                return collection.find_one({'_id': job_id}) or doc
+
+        debug(f"Submitting {kind} job {job_id} ({params}).")
+        try:
+            future = self._pool().submit(run_job, job_id, kind, list(load_edges()), params)
+        except Exception as e:
+            self._finish(job_id, error=f"Could not start job: {e}")
+            return collection.find_one({'_id': job_id})
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return doc
+
+    def _needs_rerun(self, doc):
+        if doc['status'] == 'failed':
+            return True
+        heartbeat = doc.get('heartbeat')
+        if doc['status'] in ACTIVE and heartbeat is not None:
+            if heartbeat.tzinfo is None: # MongoDB hands datetimes back naive (UTC)
+                heartbeat = heartbeat.replace(tzinfo=timezone.utc)
+            return (_now() - heartbeat).total_seconds() > JOB_STALE_SECONDS
+        return False
+
+    def _listen(self, queue):
+        # Progress messages from the pool processes -> job documents
+        while True:
+            try:
+                job_id, progress, message = queue.get()
+            except (EOFError, OSError):
+                return
+            db = self._get_db()
+            if db is None:
+                continue
+            now = _now()
+            update = {'$set': {'status': 'running', 'progress': progress, 'message': message, 'heartbeat': now}}
+            db.analysis_jobs.update_one({'_id': job_id, 'status': 'queued'}, {'$set': {'started_at': now}})
+            db.analysis_jobs.update_one({'_id': job_id, 'status': {'$in': list(ACTIVE)}}, update)
+
+    def _on_done(self, job_id, future):
+        try:
+            self._finish(job_id, result=future.result())
+        except Exception as e:
+            self._finish(job_id, error=str(e) or type(e).__name__)
+
+    def _finish(self, job_id, result=None, error=None):
+        db = self._get_db()
+        if db is None:
+            return
+        now = _now()
+        if error:
+            print(f"Analysis job {job_id} failed: {error}")
+            update = {'status': 'failed', 'message': "Failed", 'error': error}
+        else:
+            debug(f"Analysis job {job_id} done.")
+            update = {'status': 'done', 'message': "Done", 'progress': 1.0, 'result': result}
+        update.update(finished_at=now, heartbeat=now)
+        doc = db.analysis_jobs.find_one({'_id': job_id}, {'submitted_at': 1})
+        if doc is not None:
+            submitted = doc['submitted_at']
+            if submitted.tzinfo is None: # MongoDB hands datetimes back naive (UTC)
+                submitted = submitted.replace(tzinfo=timezone.utc)
+            update['duration_seconds'] = round((now - submitted).total_seconds(), 2)
+        db.analysis_jobs.update_one({'_id': job_id}, {'$set': update})
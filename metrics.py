@@ -0,0 +1,126 @@
+# metrics.py
+# Timing spans and counters for the hot paths (MongoDB queries, matrix lookups, graph
+# builds, each centrality/community algorithm, template rendering, whole requests),
+# exported in the Prometheus text format by /metrics. No client library needed.
+# Each process (e.g. each gunicorn worker) keeps and serves its own numbers.
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, template_rendered, before_render_template
+
+# Per-request progress prints ("Processing data for ...", "Calculating pagerank ...");
+# TRADE_DEBUG_LOG=0 turns them off. Errors and lifecycle messages always print.
+DEBUG_LOG = os.environ.get("TRADE_DEBUG_LOG", "1") != "0"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def debug(message):
+    if DEBUG_LOG:
+        print(message)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {} # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = [(key, list(series)) for key, series in sorted(self._series.items())]
+        for key, series in series_items:
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': repr(float(bound))})} {count}")
+            lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': '+Inf'})} {series[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_label_text(labels)} {series[-1]}")
+        return lines
+
+
+# --- The registry ---
+REQUEST_SECONDS = Histogram('trade_http_request_duration_seconds', "Whole request handling time.",
+                            ('endpoint', 'method', 'status'))
+SPAN_SECONDS = Histogram('trade_span_duration_seconds', "Time spent in one instrumented stage of a request or background job.",
+                         ('span', 'detail'))
+DB_ROWS = Histogram('trade_db_rows', "Rows a MongoDB query returned to the app (per query): documents for a find, "
+                    "result rows (partners, years, ranking rows) for an aggregation.", ('query',), buckets=COUNT_BUCKETS)
+HISTOGRAMS = [REQUEST_SECONDS, SPAN_SECONDS, DB_ROWS]
+
+
+@contextmanager
+def span(name, detail=''):
+    # with span('db_query', 'country_detail'): ...  -> trade_span_duration_seconds{span,detail}
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - started, span=name, detail=detail)
+
+
+def count_rows(query, rows):
+    DB_ROWS.observe(rows, query=query)
+    return rows
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+# --- Flask hooks: whole-request and template render timings ---
+def _request_started():
+    g.metrics_started = time.perf_counter()
+
+
+def _request_finished(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or 'unknown',
+                                method=request.method, status=response.status_code)
+    return response
+
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):
+    starts = g.get('metrics_templates')
+    if starts:
+        SPAN_SECONDS.observe(time.perf_counter() - starts.pop(), span='template_render', detail=template.name)
+
+
+def instrument_app(app):
+    app.before_request(_request_started)
+    app.after_request(_request_finished)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
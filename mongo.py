@@ -0,0 +1,91 @@
+# mongo.py
+# Lazy, retrying, fork-safe MongoDB access. Nothing connects at import time: the first
+# caller in each process (e.g. each gunicorn worker) creates its own pooled client,
+# and a failed connection is retried with backoff on later calls instead of sticking.
+import os
+import threading
+import time
+import pymongo
+from trade_queries import ensure_indexes
+
+MONGO_URI = os.environ.get("MONGO_URI")
+DB_NAME = os.environ.get("MONGO_DB", "trade_db")
+CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "2000"))
+MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "20")) # Per worker process
+MAX_RETRY_DELAY = 30 # Seconds between reconnect attempts, at most
+# Create any missing indexes in the background after connecting (0 leaves it to ingest.py)
+ENSURE_INDEXES = os.environ.get("MONGO_ENSURE_INDEXES", "1") != "0"
+
+_lock = threading.Lock()
+_client = None
+_db = None
+_pid = None
+_status = "MongoDB not connected yet."
+_retry_at = 0.0
+_retry_delay = 1.0
+
+
+def _reset_after_fork():
+    # PyMongo clients must not be shared across fork(); the child starts from scratch
+    global _lock, _client, _db, _pid, _retry_at, _retry_delay
+    _lock = threading.Lock()
+    _client = _db = _pid = None
+    _retry_at, _retry_delay = 0.0, 1.0
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_db():
+    # The trade_db Database, or None while MongoDB is unreachable
+    global _client, _db, _pid, _status, _retry_at, _retry_delay
+    if _db is not None and _pid == os.getpid():
+        return _db
+    with _lock:
+        if _db is not None and _pid == os.getpid():
+            return _db
+        if time.monotonic() < _retry_at:
+            return None
+        try:
+            client = pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=CONNECT_TIMEOUT_MS,
+                                         maxPoolSize=MAX_POOL_SIZE, minPoolSize=0, connect=False)
+            client.admin.command('ping')
+            db = client[DB_NAME]
+            _client, _db, _pid = client, db, os.getpid()
+            _status = "MongoDB connection successful!"
+            _retry_delay = 1.0
+            print(f"Connected to MongoDB (pid {_pid}).")
+            if ENSURE_INDEXES:
+                # Off the lock and off the request: on a fresh or large collection an index build takes a while
+                threading.Thread(target=_ensure_indexes, args=(db,), name="mongo-indexes", daemon=True).start()
+            return _db
+        except Exception as e:
+            _status = f"MongoDB connection failed: {e}"
+            _retry_at = time.monotonic() + _retry_delay
+            print(f"Could not connect to MongoDB, retrying in {_retry_delay:.0f}s: {e}")
+            _retry_delay = min(_retry_delay * 2, MAX_RETRY_DELAY)
+            return None
+
+
+def _ensure_indexes(db):
+    try:
+        ensure_indexes(db) # Per index, so one failure doesn't stop the rest (ingest.py creates them too)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not create trade_records indexes: {e}")
+
+
+def get_client():
+    return _client if get_db() is not None else None
+
+
+def db_status():
+    return _status
+
+
+def set_db(db, client=None):
+    # Point the app at an existing Database (e.g. a mongomock stand-in for benchmarks)
+    global _client, _db, _pid, _status
+    with _lock:
+        _client, _db, _pid = client, db, os.getpid()
+        _status = "MongoDB connection successful!" if db is not None else "MongoDB not connected yet."
@@ -0,0 +1,171 @@
+# network_analytics.py
+# Graph-derived results for /network_analysis, computed once per data version
+# by a background thread and served from a versioned snapshot.
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+import networkx as nx
+from centrality import METRICS, CHEAP_METRICS, get_backend
+from metrics import debug, span
+
+RETRY_BASE_SECONDS = 2 # A failed snapshot build is retried on request after 2s, 4s, 8s, ...
+RETRY_MAX_SECONDS = 120
+
+
+def compute_network_snapshot(G, find_communities, top_n=20, backend='networkx', progress=None):
+    # progress(steps_done, message), if given, is called after each metric and after Louvain
+    centrality_results = {} # Dictionary to hold centrality results
+    community_results = [] # List to hold communities
+    graph_info = {'nodes': G.number_of_nodes(), 'edges': G.number_of_edges(), 'backend': backend}
+
+    # Degree, strength, betweenness, eigenvector and PageRank from the selected backend (see centrality.py)
+    centrality = get_backend(G, backend)
+    for metric in METRICS:
+        debug(f"Calculating {metric} ({backend})...")
+        try:
+            with span('centrality', f"{metric}/{backend}"):
+                scores = getattr(centrality, metric)()
+            centrality_results[metric] = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_n]
+        except nx.PowerIterationFailedConvergence as e_conv:
+            print(f"{metric} did not converge: {e_conv}")
+            centrality_results[metric] = [("Convergence Error", f"{e_conv}")]
+        except Exception as e_metric:
+            print(f"Error calculating {metric}: {e_metric}")
+            centrality_results[metric] = [("Calculation Error", f"{e_metric}")]
+        if progress is not None:
+            progress(len(centrality_results), f"Calculated {metric}")
+
+    # Communities come from the shared consensus cache (see trade_graph.py)
+    try:
+        community_results = find_communities()
+    except Exception as e_comm:
+        print(f"Error calculating communities: {e_comm}")
+        community_results = []
+    if progress is not None:
+        progress(len(METRICS) + 1, "Calculated communities")
+
+    return {'results': centrality_results, 'communities': community_results, 'graph_info': graph_info, 'error': None}
+
+
+class NetworkAnalyticsCache:
+    # build_graph() must return (data_version, nx.DiGraph); the graph may be None when there is no data.
+    # find_communities(data_version) returns the (consensus) partition for that version.
+    def __init__(self, build_graph, find_communities, top_n=20, backend='networkx'):
+        self._build_graph = build_graph
+        self._find_communities = find_communities
+        self._top_n = top_n
+        self._backend = backend
+        self._snapshot = None
+        self._pending = None # Version waiting to be computed
+        self._running = None # Version currently being computed
+        self._cond = threading.Condition()
+        self._thread = None
+        self._failures = 0 # Failed builds in a row; sets the retry backoff
+
+    def get(self, version, wait=0.0):
+        # Serve the stored snapshot; schedule a recompute if it belongs to another data version
+        deadline = time.monotonic() + wait
+        with self._cond:
+            if self._snapshot is None or self._snapshot['version'] != version or self._retry_due(self._snapshot):
+                self._schedule(version)
+            while self._snapshot is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            snapshot = self._snapshot
+            return snapshot, self._status(snapshot, version)
+
+    def invalidate(self, version):
+        with self._cond:
+            # Caches nobody has asked for yet stay idle until their first request
+            if self._snapshot is not None or self._pending is not None or self._running is not None:
+                self._schedule(version, force=True)
+
+    def advance(self, old_version, new_version, G=None, changed=False):
+        # The data moved from old_version to new_version by a patch (see change_feed.py). If this
+        # graph didn't change the snapshot simply carries over; otherwise degree/strength are
+        # recomputed from the patched graph G right away and the rest is flagged stale until
+        # the background recompute replaces the snapshot.
+        with self._cond:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot['version'] != old_version:
+                return
+            if not changed:
+                self._snapshot = {**snapshot, 'version': new_version}
+                return
+            results, graph_info = dict(snapshot['results']), snapshot['graph_info']
+            stale_metrics = [m for m in METRICS if m not in CHEAP_METRICS] + ['communities']
+            if G is not None and results:
+                centrality = get_backend(G, self._backend)
+                for metric in CHEAP_METRICS:
+                    with span('centrality', f"{metric}/{self._backend}"):
+                        scores = getattr(centrality, metric)()
+                    results[metric] = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:self._top_n]
+                graph_info = {**graph_info, 'nodes': G.number_of_nodes(), 'edges': G.number_of_edges()}
+            else:
+                stale_metrics = list(METRICS) + ['communities']
+            self._snapshot = {**snapshot, 'results': results, 'graph_info': graph_info, 'version': new_version,
+                              'stale_metrics': stale_metrics}
+            self._schedule(new_version, force=True)
+
+    def _retry_due(self, snapshot):
+        # A failed build (e.g. MongoDB unreachable) isn't final for its version: retried with backoff
+        return snapshot.get('retry_at') is not None and time.monotonic() >= snapshot['retry_at']
+
+    def _schedule(self, version, force=False):
+        if not force and version in (self._pending, self._running):
+            return
+        self._pending = version
+        if self._thread is None or not self._thread.is_alive():
+            # Started lazily so every (forked) gunicorn worker gets its own thread
+            self._thread = threading.Thread(target=self._worker, name=f"network-analytics-{self._backend}", daemon=True)
+            self._thread.start()
+        self._cond.notify_all()
+
+    def _status(self, snapshot, version):
+        status = {'current_version': version, 'recomputing': self._pending is not None or self._running is not None}
+        if snapshot is not None:
+            status.update(version=snapshot['version'], stale=snapshot['version'] != version,
+                          computed_at=snapshot['computed_at'],
+                          age_seconds=round(time.time() - snapshot['computed_ts'], 1),
+                          duration_seconds=snapshot['duration_seconds'],
+                          stale_metrics=snapshot.get('stale_metrics', []))
+        return status
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                requested, self._pending = self._pending, None
+                self._running = requested
+            started = time.time()
+            try:
+                version, G = self._build_graph()
+                if G is None or G.number_of_nodes() == 0 or G.number_of_edges() == 0:
+                    snapshot = {'results': {}, 'communities': [], 'graph_info': {},
+                                'error': "Graph could not be built (no valid nodes/edges)."}
+                else:
+                    debug(f"Recomputing network analytics ({self._backend}) for data version {version}...")
+                    snapshot = compute_network_snapshot(G, lambda: self._find_communities(version),
+                                                        top_n=self._top_n, backend=self._backend)
+            except Exception as e:
+                version = requested
+                self._failures += 1
+                delay = min(RETRY_BASE_SECONDS * 2 ** (self._failures - 1), RETRY_MAX_SECONDS)
+                snapshot = {'results': {}, 'communities': [], 'graph_info': {}, 'retry_at': time.monotonic() + delay,
+                            'error': f"Error during network analysis (retrying in {delay:g}s): {e}\n{traceback.format_exc()}"}
+                print(snapshot['error'])
+            else:
+                self._failures = 0
+            finished = time.time()
+            snapshot.update(version=version, computed_ts=finished,
+                            computed_at=datetime.fromtimestamp(finished, timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"),
+                            duration_seconds=round(finished - started, 2))
+            with self._cond:
+                self._snapshot = snapshot
+                self._running = None
+                self._cond.notify_all()
+            print(f"Network analytics snapshot ready (version {version}, {snapshot['duration_seconds']}s).")
@@ -0,0 +1,143 @@
+# pagination.py
+# Cursor (keyset) pagination, server-side sort/filter of a country's partner table, and
+# streaming CSV/JSON exports. A cursor is the sort key of the last row on a page, so the
+# next page starts right after it: no skip/offset scans, and no rows repeated or lost when
+# a page boundary shifts. Exports are generators, so large results are never held whole.
+import base64
+import csv
+import io
+import json
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+EXPORT_FORMATS = ('csv', 'json')
+STREAM_CHUNK_BYTES = 64 * 1024 # Exports are yielded in pieces about this big
+
+PARTNER_SORTS = ('partner', 'export', 'import', 'balance')
+PARTNER_FIELDS = ('partner', 'export', 'import', 'balance', 'export_reported', 'import_reported')
+
+# Cursor shapes: the type of each element of the key list
+NUMBER, TEXT = 'number', 'text'
+RECORD_CURSOR = (NUMBER, TEXT) # /data: [value, _id]
+
+
+def encode_cursor(key):
+    # key: a JSON-able list, e.g. [value, id] of the last row shown
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _is(value, kind):
+    if kind == NUMBER:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, str)
+
+
+def decode_cursor(token, shape):
+    # The key list, None when there is no cursor; ValueError for one that wasn't ours or
+    # doesn't fit `shape` (e.g. RECORD_CURSOR, partner_cursor(sort))
+    if not token:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page cursor.")
+    if not isinstance(key, list) or len(key) != len(shape) or not all(_is(v, kind) for v, kind in zip(key, shape)):
+        raise ValueError("Invalid page cursor.")
+    return key
+
+
+def partner_cursor(sort):
+    # Partner-table cursor shape: [partner] or [value, partner]
+    return (TEXT,) if sort == 'partner' else (NUMBER, TEXT)
+
+
+def page_size(raw):
+    # ?limit= -> rows per page (ValueError outside 1..MAX_PAGE_SIZE)
+    if raw in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    try:
+        size = int(raw)
+    except ValueError:
+        raise ValueError("'limit' must be an integer.")
+    if not 1 <= size <= MAX_PAGE_SIZE:
+        raise ValueError(f"'limit' must be between 1 and {MAX_PAGE_SIZE}.")
+    return size
+
+
+# --- A country's partner table ---
+def partner_rows(partner_data, sort='partner', descending=False, flow=None, search=None):
+    # partner_data ({partner: {export, import, ...}}) as a filtered, sorted list of rows.
+    # flow='export'/'import' keeps partners with a non-zero flow that way; search matches
+    # partner names case-insensitively. Ties sort by partner name, so the order is total.
+    search = search.casefold() if search else None
+    rows = [{'partner': partner, **{key: data[key] for key in PARTNER_FIELDS[1:]}}
+            for partner, data in partner_data.items()
+            if (not flow or data[flow]) and (not search or search in partner.casefold())]
+    if sort == 'partner':
+        rows.sort(key=lambda row: row['partner'], reverse=descending)
+    else:
+        rows.sort(key=lambda row: row['partner'])
+        rows.sort(key=lambda row: row[sort], reverse=descending) # Stable: names stay ascending within ties
+    return rows
+
+
+def _sort_key(row, sort):
+    return [row['partner']] if sort == 'partner' else [row[sort], row['partner']]
+
+
+def _after(key, cursor, sort, descending):
+    # Whether a row with sort key `key` comes after the cursor row
+    if sort == 'partner':
+        return key[0] < cursor[0] if descending else key[0] > cursor[0]
+    value, partner = key
+    if value != cursor[0]:
+        return value < cursor[0] if descending else value > cursor[0]
+    return partner > cursor[1]
+
+
+def page_rows(rows, sort, descending, after=None, limit=DEFAULT_PAGE_SIZE):
+    # (page, next_cursor) for rows from partner_rows; next_cursor is None on the last page
+    start = 0
+    if after is not None:
+        start = next((i for i, row in enumerate(rows) if _after(_sort_key(row, sort), after, sort, descending)), len(rows))
+    page = rows[start:start + limit]
+    next_cursor = encode_cursor(_sort_key(page[-1], sort)) if page and start + limit < len(rows) else None
+    return page, next_cursor
+
+
+# --- Streaming exports ---
+def _chunked(pieces):
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_BYTES:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_csv(rows, fields):
+    # CSV text for `rows` (dicts), header first, yielded as it is produced
+    def pieces():
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([row.get(field) for field in fields])
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+        yield out.getvalue()
+    return _chunked(pieces())
+
+
+def stream_json(rows, fields):
+    # A JSON array of `rows` (only `fields`), yielded element by element
+    def pieces():
+        yield '['
+        for i, row in enumerate(rows):
+            yield (',\n' if i else '\n') + json.dumps({field: row.get(field) for field in fields})
+        yield '\n]\n'
+    return _chunked(pieces())
@@ -0,0 +1,49 @@
+# process_pool.py
+# The one process pool of each app process, shared by analysis jobs (jobs.py) and the
+# parallel seeded runs behind consensus partitions (trade_graph.py). It is sized so that all
+# gunicorn workers together fill the machine's cores instead of each starting several
+# pools of its own. Pool processes also get a queue for reporting job progress back.
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# WEB_CONCURRENCY is the gunicorn worker count (gunicorn reads it as well)
+_APP_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+POOL_WORKERS = int(os.environ.get("ANALYSIS_POOL_WORKERS", str(max(1, (os.cpu_count() or 1) // _APP_WORKERS))))
+
+_lock = threading.Lock()
+_pool = None
+_queue = None # App process: the pool's progress queue; pool process: set by _init_worker
+
+
+def _reset_after_fork():
+    # Pools don't survive fork(); the child starts its own on demand
+    global _lock, _pool, _queue
+    _lock = threading.Lock()
+    _pool = _queue = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+
+def shared_pool():
+    global _pool, _queue
+    with _lock:
+        if _pool is None:
+            # spawn, not fork: the app process has live threads and MongoDB sockets
+            context = multiprocessing.get_context('spawn')
+            _queue = context.Queue()
+            _pool = ProcessPoolExecutor(POOL_WORKERS, mp_context=context, initializer=_init_worker, initargs=(_queue,))
+        return _pool
+
+
+def progress_queue():
+    # Where pool processes put progress messages (see jobs._report); the app process reads it
+    return _queue
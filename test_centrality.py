@@ -0,0 +1,52 @@
+# test_centrality.py
+# The sparse backend must match NetworkX (see centrality.check_parity):  python -m pytest -q
+import os
+import networkx as nx
+import numpy as np
+import pytest
+from centrality import METRICS, check_parity, get_backend
+from ingest import _to_record, detect_encoding, iter_csv_rows
+from trade_graph import build_export_graph
+from trade_matrix import TradeMatrix
+
+TOLERANCE = 1e-9 # Largest relative difference allowed per metric
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trade_data_global_2024.csv')
+
+
+def _assert_parity(G):
+    report = check_parity(G)
+    assert set(report) == set(METRICS)
+    for metric, diff in report.items():
+        assert diff < TOLERANCE, f"{metric}: max relative difference {diff:.2e}"
+
+
+def test_parity_seeded_random_graph():
+    rng = np.random.default_rng(42)
+    G = nx.gnp_random_graph(120, 0.1, directed=True, seed=42)
+    for u, v in G.edges():
+        G[u][v]['weight'] = float(rng.lognormal(15, 3)) # Trade-like, heavy-tailed values
+    _assert_parity(G)
+
+
+def test_parity_ties_and_dangling_nodes():
+    # Two equally short routes S -> M1/M2 -> T (shortest paths split between them, so M1 and
+    # M2 tie on betweenness), sinks with no out-edges (dangling for PageRank) and a source
+    # nothing points to
+    G = nx.DiGraph()
+    G.add_weighted_edges_from([('S', 'M1', 4.0), ('S', 'M2', 4.0), ('M1', 'T', 4.0), ('M2', 'T', 4.0), ('T', 'S', 1.0),
+                               ('T', 'Sink1', 2.0), ('S', 'Sink2', 7.0), ('Source', 'S', 3.0)], weight='weight')
+    betweenness = get_backend(G, 'networkx').betweenness()
+    assert betweenness['M1'] == betweenness['M2'] > 0 # The tie is really there
+    assert not any(G.out_degree(node) for node in ('Sink1', 'Sink2'))
+    _assert_parity(G)
+
+
+@pytest.mark.skipif(not os.path.exists(CSV_PATH), reason="bundled 2024 CSV not present")
+def test_parity_bundled_2024_data():
+    records = (_to_record(row) for row in iter_csv_rows(CSV_PATH, detect_encoding(CSV_PATH)))
+    matrix = TradeMatrix.from_records(record for record in records if record is not None)
+    src, dst, weights = matrix.export_edges(2024)
+    names = np.asarray(matrix.countries, dtype=object)
+    G = build_export_graph(zip(names[src], names[dst], weights.tolist()))
+    assert G.number_of_nodes() > 100
+    _assert_parity(G)
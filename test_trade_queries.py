@@ -0,0 +1,102 @@
+# test_trade_queries.py
+# The direct/mirror reconciliation rule (a country's own report first, its partner's mirror
+# report as fallback; World totals reported, else summed over partners) is implemented four
+# times: TradeMatrix.reconciled, the country detail and trend aggregations, and the
+# materialized country_summaries. They must agree:  python -m pytest -q
+import math
+import os
+import pytest
+from ingest import _to_record, detect_encoding, iter_csv_rows
+from trade_matrix import TradeMatrix
+from trade_queries import (country_detail_from_db, country_summary_from_db, country_trend_from_db, pair_trend_from_db,
+                           rank_countries_from_db, rank_partners_from_db, write_country_summaries)
+
+mongomock = pytest.importorskip('mongomock')
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trade_data_global_2024.csv')
+
+# Direct only, mirror only, both (and disagreeing), reported and missing World totals, over two years
+RECORDS = [
+    (2023, 'A', 'B', 'Export', 100.0), (2023, 'B', 'A', 'Import', 90.0),
+    (2023, 'A', 'C', 'Export', 50.0),
+    (2023, 'C', 'A', 'Export', 30.0),
+    (2023, 'D', 'A', 'Import', 7.0),
+    (2023, 'B', 'C', 'Export', 20.0), (2023, 'C', 'B', 'Import', 25.0),
+    (2023, 'A', 'World', 'Export', 1000.0),
+    (2023, 'B', 'World', 'Import', 500.0),
+    (2024, 'A', 'B', 'Export', 120.0), (2024, 'B', 'A', 'Export', 60.0),
+    (2024, 'C', 'A', 'Import', 40.0),
+    (2024, 'A', 'D', 'Export', 11.0), (2024, 'D', 'A', 'Import', 10.0),
+    (2024, 'D', 'World', 'Export', 80.0),
+]
+
+
+def _load(records):
+    # (mongomock db holding `records` plus a built country_summaries, matrix of the same records)
+    db = mongomock.MongoClient()['trade_db']
+    db.trade_records.insert_many([dict(record) for record in records])
+    matrix = TradeMatrix.from_records(records)
+    write_country_summaries(db, matrix.summary_documents(), matrix.years)
+    return db, matrix
+
+
+def _same(expected, actual, path=''):
+    if isinstance(expected, dict):
+        assert set(expected) == set(actual), path
+        for key in expected:
+            _same(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, list):
+        assert len(expected) == len(actual), path
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            _same(e, a, f"{path}[{i}]")
+    elif isinstance(expected, float) or isinstance(actual, float):
+        assert math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-6), f"{path}: {expected} != {actual}"
+    else:
+        assert expected == actual, path
+
+
+def _assert_country_parity(db, matrix, countries, years):
+    for year in years:
+        for country in countries:
+            world_data, partner_data, found = matrix.country_detail(country, year)
+            for from_db in (country_detail_from_db(db, country, year), country_summary_from_db(db, country, year)):
+                assert from_db[2] == found, (country, year)
+                if found:
+                    _same(world_data, from_db[0], f"{country} {year} world")
+                    _same(partner_data, from_db[1], f"{country} {year} partners")
+        for country in countries:
+            _same(matrix.country_trend(country), country_trend_from_db(db, country), f"{country} trend")
+
+
+def _assert_ranking_parity(db, matrix, years, partners_of=(None,)):
+    # partners_of: countries whose partner rankings to compare (None: across all countries)
+    for year in years:
+        for order in ('surplus', 'deficit'):
+            _same(matrix.balance_ranking('countries', order, 10, year), rank_countries_from_db(db, year, order, 10),
+                  f"countries {order} {year}")
+            for country in partners_of:
+                _same(matrix.balance_ranking('partners', order, 10, year, country), rank_partners_from_db(db, year, order, 10, country),
+                      f"partners {order} {year} {country}")
+
+
+def test_reconciliation_parity_small_dataset():
+    records = [{'year': y, 'reporter': r, 'partner': p, 'flow': f, 'value': v} for y, r, p, f, v in RECORDS]
+    db, matrix = _load(records)
+    countries = ['A', 'B', 'C', 'D', 'E'] # E has no data
+    _assert_country_parity(db, matrix, countries, [2023, 2024])
+    _assert_ranking_parity(db, matrix, [2023, 2024], partners_of=(None, 'A'))
+    for pair in (('A', 'B'), ('A', 'D'), ('B', 'C')):
+        _same(matrix.pair_trend(*pair), pair_trend_from_db(db, *pair), f"{pair} pair trend")
+
+
+@pytest.mark.skipif(not os.path.exists(CSV_PATH), reason="bundled 2024 CSV not present")
+def test_reconciliation_parity_bundled_2024_data():
+    records = [record for record in (_to_record(row) for row in iter_csv_rows(CSV_PATH, detect_encoding(CSV_PATH)))
+               if record is not None]
+    db, matrix = _load(records)
+    # A few countries only: mongomock runs each aggregation as a full scan (the partner
+    # ranking across all countries is covered by the small dataset)
+    _assert_country_parity(db, matrix, ['USA', 'Germany'], [2024])
+    _assert_ranking_parity(db, matrix, [2024], partners_of=('Germany',))
+    for pair in (('USA', 'China'), ('Germany', 'France')):
+        _same(matrix.pair_trend(*pair), pair_trend_from_db(db, *pair), f"{pair} pair trend")
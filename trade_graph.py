@@ -0,0 +1,276 @@
+# trade_graph.py
+# One export graph per (data version, year), built in bulk and shared by /network_analysis,
+# /clusters and anything else that needs it; consensus community results are cached alongside.
+# `key` below is any hashable identifying the data, e.g. (version, year).
+import os
+import threading
+from collections import OrderedDict
+from itertools import repeat
+import numpy as np
+import networkx as nx
+from networkx.algorithms import community as nx_community
+from metrics import debug, span
+from process_pool import shared_pool, POOL_WORKERS
+
+CONSENSUS_RUNS = int(os.environ.get("CONSENSUS_RUNS", "32")) # Seeded runs behind each consensus partition
+CONSENSUS_WORKERS = int(os.environ.get("CONSENSUS_WORKERS", str(POOL_WORKERS))) # Chunks of runs sent to the shared pool
+CONSENSUS_THRESHOLD = 0.5 # Pairs co-assigned in more than this share of runs stay together
+# "leiden" needs a NetworkX backend that implements it (plain NetworkX only dispatches); Louvain otherwise
+COMMUNITY_METHOD = os.environ.get("COMMUNITY_METHOD", "louvain")
+
+
+def build_export_graph(edges):
+    # edges: iterable of (reporter, partner, value)
+    G = nx.DiGraph() # Directed graph
+    G.add_weighted_edges_from(edges, weight='weight')
+    return G
+
+
+# --- Consensus of many seeded runs: deterministic, with per-country stability ---
+def _community_method(method):
+    if method == 'leiden':
+        try:
+            nx_community.leiden_communities(nx.path_graph(2), seed=0)
+            return 'leiden'
+        except NotImplementedError:
+            print("No NetworkX backend implements Leiden here; using Louvain.")
+    return 'louvain'
+
+
+def _detect(U, method, resolution, seed):
+    detect = nx_community.leiden_communities if method == 'leiden' else nx_community.louvain_communities
+    return detect(U, weight='weight', resolution=resolution, seed=seed)
+
+
+def _label_runs(nodes, edges, method, resolution, seeds):
+    # One community label per node for each seed, plus that run's modularity. Module-level so
+    # pool processes can run it; the graph is rebuilt the same way everywhere so a seed's
+    # result doesn't depend on which process ran it.
+    U = nx.Graph()
+    U.add_nodes_from(nodes)
+    U.add_weighted_edges_from(edges, weight='weight')
+    index = {node: i for i, node in enumerate(nodes)}
+    runs = []
+    for seed in seeds:
+        partition = _detect(U, method, resolution, seed)
+        labels = np.empty(len(nodes), dtype=np.int32)
+        for label, members in enumerate(partition):
+            labels[[index[m] for m in members]] = label
+        runs.append((labels, nx_community.modularity(U, partition, weight='weight', resolution=resolution)))
+    return runs
+
+
+def consensus_communities(U, runs=CONSENSUS_RUNS, resolution=1.0, seed=0, method=COMMUNITY_METHOD, workers=CONSENSUS_WORKERS):
+    # Runs seeds seed..seed+runs-1 (in parallel when workers > 1), counts how often each pair of
+    # countries lands in the same community, and partitions the graph of pairs that did so in
+    # more than CONSENSUS_THRESHOLD of the runs. Stability of a country = its mean co-assignment
+    # with the rest of its consensus community (share of runs it was alone, for singletons).
+    method = _community_method(method)
+    nodes = sorted(U.nodes())
+    edges = list(U.edges(data='weight', default=1.0))
+    seeds = list(range(seed, seed + runs))
+    with span('communities', f"consensus/{method}"):
+        workers = max(1, min(workers, runs))
+        if workers > 1:
+            chunks = shared_pool().map(_label_runs, repeat(nodes), repeat(edges), repeat(method), repeat(resolution),
+                                       [seeds[i::workers] for i in range(workers)])
+            results = [run for chunk in chunks for run in chunk]
+        else:
+            results = _label_runs(nodes, edges, method, resolution, seeds)
+
+        labels = np.vstack([labels for labels, _ in results]) # (runs, n)
+        co_assigned = np.zeros((len(nodes), len(nodes)))
+        for run_labels in labels:
+            co_assigned += run_labels[:, None] == run_labels[None, :]
+        co_assigned /= runs
+
+        consensus_graph = nx.Graph()
+        consensus_graph.add_nodes_from(nodes)
+        rows, cols = np.nonzero(np.triu(co_assigned > CONSENSUS_THRESHOLD, 1))
+        consensus_graph.add_weighted_edges_from(((nodes[i], nodes[j], co_assigned[i, j]) for i, j in zip(rows, cols)), weight='weight')
+        communities = [sorted(c) for c in _detect(consensus_graph, method, 1.0, seed)]
+        communities.sort(key=lambda c: (-len(c), c[0]))
+
+    index = {node: i for i, node in enumerate(nodes)}
+    alone = np.mean([np.bincount(run_labels)[run_labels] == 1 for run_labels in labels], axis=0) # Share of runs as a singleton
+    stability = []
+    for community in communities:
+        members = [index[m] for m in community]
+        if len(members) == 1:
+            stability.append([round(float(alone[members[0]]), 4)])
+        else:
+            block = co_assigned[np.ix_(members, members)]
+            stability.append([round(float((block[k].sum() - 1.0) / (len(members) - 1)), 4) for k in range(len(members))])
+
+    run_modularity = [m for _, m in results]
+    return {
+        'communities': communities,
+        'stability': stability, # Aligned with communities: stability[i][k] is for communities[i][k]
+        'modularity': round(nx_community.modularity(U, communities, weight='weight', resolution=resolution), 4),
+        'run_modularity': {'mean': round(float(np.mean(run_modularity)), 4), 'min': round(min(run_modularity), 4),
+                           'max': round(max(run_modularity), 4)},
+        'runs': runs, 'seed': seed, 'method': method, 'resolution': resolution,
+    }
+
+
+class TradeGraphCache:
+    def __init__(self, max_graphs=4, max_partitions=32):
+        self._max_graphs = max_graphs # A few years can be browsed side by side without rebuilding
+        self._max_partitions = max_partitions
+        self._graph_lock = threading.Lock()
+        self._partition_lock = threading.Lock()
+        self._graphs = OrderedDict() # key -> [graph, undirected or None], least recently used first
+        self._partitions = {} # (key, resolution, ('consensus', runs)) -> consensus result
+        self._computing = {} # Partition key -> Event set when its computation finishes
+        self._errors = {} # Partition key -> why its last background computation failed
+
+    def graph(self, key, load_edges):
+        with self._graph_lock:
+            entry = self._graphs.get(key)
+            if entry is None:
+                debug(f"Building export graph for {key}...")
+                with span('graph_build', 'export'):
+                    entry = self._graphs[key] = [build_export_graph(load_edges()), None]
+                if len(self._graphs) > self._max_graphs:
+                    self._graphs.popitem(last=False)
+                debug(f"Graph built with {entry[0].number_of_nodes()} nodes and {entry[0].number_of_edges()} edges.")
+            self._graphs.move_to_end(key)
+            return entry[0]
+
+    def undirected(self, key, load_edges):
+        G = self.graph(key, load_edges)
+        with self._graph_lock:
+            entry = self._graphs.get(key)
+            if entry is None or entry[0] is not G: # Evicted meanwhile
+                return G.to_undirected()
+            if entry[1] is None:
+                entry[1] = G.to_undirected()
+            return entry[1]
+
+    def consensus(self, key, load_edges, resolution=1.0, runs=CONSENSUS_RUNS, allow_stale=True, wait=True):
+        # Deterministic (seeds 0..runs-1), so one result per data version and year is enough.
+        # Background callers pass allow_stale=False to wait for a recompute instead. Pages pass
+        # wait=False: None while the partition is computed in the background (like the
+        # network snapshot), instead of computing it inside the request. Concurrent callers
+        # for the same key share one computation.
+        partition_key = (key, resolution, ('consensus', runs))
+        while True:
+            with self._partition_lock:
+                result = self._partitions.get(partition_key)
+                if result is not None and (allow_stale or not result.get('stale')):
+                    if result.get('stale'): # Data changed under it (see advance): serve it while recomputing
+                        self._compute_later(partition_key, load_edges)
+                    return result
+                if not wait:
+                    error = self._errors.pop(partition_key, None)
+                    if error is not None: # Reported once; the next call tries again
+                        raise RuntimeError(f"Consensus communities computation failed: {error}")
+                    self._compute_later(partition_key, load_edges)
+                    return None
+                done = self._computing.get(partition_key)
+                if done is None:
+                    done = self._computing[partition_key] = threading.Event()
+                    done.error = None
+                    break
+            done.wait()
+            if done.error is not None:
+                raise RuntimeError(f"Consensus communities computation failed: {done.error}")
+        return self._compute(partition_key, load_edges, done)
+
+    def _compute(self, partition_key, load_edges, done):
+        key, resolution, (_, runs) = partition_key
+        try:
+            debug(f"Calculating consensus communities ({runs} runs, resolution={resolution})...")
+            result = consensus_communities(self.undirected(key, load_edges), runs=runs, resolution=resolution)
+            debug(f"Found {len(result['communities'])} consensus communities (modularity {result['modularity']}).")
+            with self._partition_lock:
+                self._store(partition_key, result)
+            return result
+        except Exception as e:
+            done.error = e
+            raise
+        finally:
+            with self._partition_lock:
+                self._computing.pop(partition_key, None)
+            done.set()
+
+    def _compute_later(self, partition_key, load_edges):
+        # Called with _partition_lock held
+        if partition_key in self._computing:
+            return
+        done = self._computing[partition_key] = threading.Event()
+        done.error = None
+
+        def compute():
+            try:
+                self._compute(partition_key, load_edges, done)
+            except Exception as e:
+                print(f"Error computing consensus communities: {e}")
+                with self._partition_lock:
+                    self._errors[partition_key] = str(e)
+
+        threading.Thread(target=compute, name="consensus-compute", daemon=True).start()
+
+    def peek(self, key):
+        # The cached graph for `key`, or None (never builds)
+        with self._graph_lock:
+            entry = self._graphs.get(key)
+            return entry[0] if entry else None
+
+    def advance(self, old_version, new_version, edge_changes):
+        # Carry graphs and consensus results from (old_version, year) to (new_version, year)
+        # without reloading. edge_changes: {year: [(reporter, partner, export value), ...]}.
+        # Changed years get a patched copy (the old graph may be in use by a background
+        # computation); their consensus results are kept, flagged stale, and recomputed on next use.
+        with self._graph_lock:
+            for key in [k for k in self._graphs if isinstance(k, tuple) and k[0] == old_version]:
+                G, U = self._graphs.pop(key)
+                year = key[1]
+                if year in edge_changes:
+                    with span('graph_build', 'patch'):
+                        G, U = G.copy(), None
+                        for src, dst, value in edge_changes[year]:
+                            if value > 0:
+                                G.add_edge(src, dst, weight=value)
+                            elif G.has_edge(src, dst):
+                                G.remove_edge(src, dst)
+                                # A full build only has nodes with edges
+                                G.remove_nodes_from([n for n in (src, dst) if G.degree(n) == 0])
+                self._graphs[(new_version, year)] = [G, U]
+        with self._partition_lock:
+            for partition_key in [k for k in self._partitions if isinstance(k[0], tuple) and k[0][0] == old_version]:
+                result = self._partitions.pop(partition_key)
+                year = partition_key[0][1]
+                if year in edge_changes:
+                    result = {**result, 'stale': True}
+                self._partitions[((new_version, year),) + partition_key[1:]] = result
+
+    def _store(self, partition_key, value):
+        # Called with _partition_lock held. Results for evicted graphs (older data versions,
+        # years nobody looks at) are dropped too.
+        with self._graph_lock:
+            live = set(self._graphs)
+        self._partitions = {k: v for k, v in self._partitions.items() if k[0] in live}
+        if len(self._partitions) >= self._max_partitions:
+            self._partitions.pop(next(iter(self._partitions)))
+        self._partitions[partition_key] = value
+
+
+# --- Process-wide shared cache ---
+_graph_cache = TradeGraphCache()
+
+
+def get_export_graph(key, load_edges):
+    return _graph_cache.graph(key, load_edges)
+
+
+def get_consensus(key, load_edges, resolution=1.0, runs=CONSENSUS_RUNS, allow_stale=True, wait=True):
+    return _graph_cache.consensus(key, load_edges, resolution=resolution, runs=runs, allow_stale=allow_stale, wait=wait)
+
+
+def peek_export_graph(key):
+    return _graph_cache.peek(key)
+
+
+def advance_graphs(old_version, new_version, edge_changes):
+    _graph_cache.advance(old_version, new_version, edge_changes)
@@ -0,0 +1,326 @@
+# trade_matrix.py
+# In-memory, NumPy-backed year x reporter x partner x flow matrix built once from
+# db.trade_records and shared by every route (instead of per-request scans).
+import hashlib
+import os
+import threading
+import numpy as np
+from metrics import span
+from trade_queries import summary_document, empty_world_data
+
+FLOWS = ("Export", "Import")
+EXPORT, IMPORT = 0, 1
+FLOW_INDEX = {flow: i for i, flow in enumerate(FLOWS)}
+WORLD = "World"
+
+
+class TradeMatrix:
+    def __init__(self, countries, years, values, reported, version=0):
+        self.countries = list(countries)
+        self.index = {name: i for i, name in enumerate(self.countries)} # country name -> row/column code
+        self.years = list(years) # Ascending
+        self.year_index = {year: i for i, year in enumerate(self.years)}
+        self.values = values # float64, shape (years, n, n, 2): [year, reporter, partner, flow]
+        self.reported = reported # bool, same shape: True where a record exists
+        self.year = self.years[-1] if self.years else "N/A" # Latest year; what views show by default
+        self.version = version
+        self.world = self.index.get(WORLD)
+        self._fingerprint = None
+        self._reconciled = {} # year -> every country's reconciled partner table (see reconciled)
+
+    @classmethod
+    def from_records(cls, records, version=0):
+        years, reporters, partners, flows, values = [], [], [], [], []
+        for record in records:
+            flow = FLOW_INDEX.get(record.get('flow'))
+            if flow is None:
+                continue
+            years.append(record['year'])
+            reporters.append(record['reporter'])
+            partners.append(record['partner'])
+            flows.append(flow)
+            values.append(record.get('value', 0) or 0)
+
+        countries = sorted(set(reporters) | set(partners))
+        index = {name: i for i, name in enumerate(countries)}
+        year_list = sorted(set(years))
+        year_index = {year: i for i, year in enumerate(year_list)}
+        shape = (len(year_list), len(countries), len(countries), len(FLOWS))
+        matrix_values = np.zeros(shape, dtype=np.float64)
+        matrix_reported = np.zeros(shape, dtype=bool)
+        if values:
+            y = np.fromiter((year_index[v] for v in years), dtype=np.intp, count=len(years))
+            r = np.fromiter((index[c] for c in reporters), dtype=np.intp, count=len(reporters))
+            p = np.fromiter((index[c] for c in partners), dtype=np.intp, count=len(partners))
+            f = np.asarray(flows, dtype=np.intp)
+            # Fancy assignment keeps the last duplicate, like overwriting a dict did
+            matrix_values[y, r, p, f] = np.asarray(values, dtype=np.float64)
+            matrix_reported[y, r, p, f] = True
+        return cls(countries, year_list, matrix_values, matrix_reported, version=version)
+
+    @classmethod
+    def from_collection(cls, collection, version=0):
+        projection = {"_id": 0, "reporter": 1, "partner": 1, "flow": 1, "value": 1, "year": 1}
+        return cls.from_records(collection.find({}, projection), version=version)
+
+    # --- Compact on-disk snapshots (written by ingest.py --snapshot) ---
+    def save_npz(self, path):
+        np.savez_compressed(path, countries=np.asarray(self.countries, dtype=str), years=np.asarray(self.years),
+                            values=self.values, reported=self.reported)
+
+    @classmethod
+    def load_snapshot(cls, path, version=0):
+        if str(path).endswith('.parquet'):
+            import pandas as pd # Only needed for Parquet snapshots
+            return cls.from_records(pd.read_parquet(path).to_dict('records'), version=version)
+        with np.load(path) as data:
+            if 'years' not in data: # Single-year snapshot from before the year axis
+                year = data['year'].item()
+                year = int(year) if str(year).isdigit() else year
+                return cls(data['countries'].tolist(), [year], data['values'][None], data['reported'][None], version=version)
+            return cls(data['countries'].tolist(), data['years'].tolist(), data['values'], data['reported'], version=version)
+
+    @property
+    def fingerprint(self):
+        # Content hash of the dataset: stable across processes and restarts, unlike `version`
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=12)
+            digest.update("\x1f".join(self.countries).encode('utf-8'))
+            digest.update(repr(self.years).encode('utf-8'))
+            digest.update(np.ascontiguousarray(self.values).tobytes())
+            digest.update(np.ascontiguousarray(self.reported).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def __len__(self):
+        return len(self.countries)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def country_names(self):
+        return [c for c in self.countries if c != WORLD]
+
+    def resolve_year(self, year=None):
+        # None means the latest year; unknown years resolve to None
+        if year is None:
+            return self.years[-1] if self.years else None
+        return year if year in self.year_index else None
+
+    def _not_world(self):
+        mask = np.ones(len(self.countries), dtype=bool)
+        if self.world is not None:
+            mask[self.world] = False
+        return mask
+
+    # --- Reconciled view of every country at once (direct data first, mirror data as fallback) ---
+    def reconciled(self, year):
+        # One vectorized pass over a year: [country, partner] export/import tables, which partners
+        # each country has, and World totals (reported, else summed from the partner rows).
+        # Kept per year; the matrix never changes in place (patches build a new one).
+        cached = self._reconciled.get(year)
+        if cached is not None:
+            return cached
+        values, reported = self.values[self.year_index[year]], self.reported[self.year_index[year]]
+        mirror = reported.transpose(1, 0, 2) # [i, j]: what j reported about i
+        mirror_values = values.transpose(1, 0, 2)
+        # Partner exported TO country -> country's IMPORT, and vice versa
+        exports = np.where(reported[:, :, EXPORT], values[:, :, EXPORT],
+                           np.where(mirror[:, :, IMPORT], mirror_values[:, :, IMPORT], 0.0))
+        imports = np.where(reported[:, :, IMPORT], values[:, :, IMPORT],
+                           np.where(mirror[:, :, EXPORT], mirror_values[:, :, EXPORT], 0.0))
+        partners = (reported.any(axis=2) | mirror.any(axis=2)) & self._not_world()[None, :]
+        found = reported.any(axis=(1, 2)) | reported.any(axis=(0, 2))
+
+        n = len(self.countries)
+        world = np.stack([np.where(partners, exports, 0.0).sum(axis=1), np.where(partners, imports, 0.0).sum(axis=1)], axis=1)
+        world_reported = np.zeros((n, len(FLOWS)), dtype=bool)
+        if self.world is not None:
+            world_reported = reported[:, self.world, :]
+            world = np.where(world_reported, values[:, self.world, :], world)
+        cached = self._reconciled[year] = {'exports': exports, 'imports': imports, 'partners': partners, 'found': found,
+                                           'world': world, 'world_reported': world_reported}
+        return cached
+
+    # --- Single country view ---
+    def country_detail(self, country, year=None):
+        world_data = empty_world_data()
+        i = self.index.get(country)
+        year = self.resolve_year(year)
+        if i is None or year is None:
+            return world_data, {}, False
+        table = self.reconciled(year)
+        exports, imports, reported = table['exports'][i], table['imports'][i], self.reported[self.year_index[year], i]
+
+        partner_data = {}
+        for j in np.flatnonzero(table['partners'][i]):
+            partner_data[self.countries[j]] = {
+                'export': float(exports[j]), 'import': float(imports[j]),
+                'balance': float(exports[j] - imports[j]),
+                'export_reported': bool(reported[j, EXPORT]), 'import_reported': bool(reported[j, IMPORT]),
+            }
+
+        for flow, key in ((EXPORT, 'export'), (IMPORT, 'import')):
+            world_data[key] = float(table['world'][i, flow])
+            world_data[key + ('_reported' if table['world_reported'][i, flow] else '_calculated')] = True
+        world_data['balance'] = world_data['export'] - world_data['import']
+        return world_data, partner_data, bool(table['found'][i])
+
+    # --- Rankings across countries (top surplus / deficit) ---
+    def balance_ranking(self, by='partners', order='surplus', limit=20, year=None, country=None):
+        # by='countries': countries by World balance; by='partners': country-partner pairs by the
+        # country's reconciled balance with that partner (only `country`'s partners when given).
+        # Only positive balances rank as surplus and negative ones as deficit.
+        year = self.resolve_year(year)
+        if year is None:
+            return []
+        table = self.reconciled(year)
+        sign = 1.0 if order == 'surplus' else -1.0
+        if by == 'countries':
+            balance = table['world'][:, EXPORT] - table['world'][:, IMPORT]
+            rows = np.flatnonzero(table['found'] & self._not_world() & (sign * balance > 0))
+            rows = rows[np.argsort(-sign * balance[rows], kind='stable')[:limit]]
+            return [{'country': self.countries[i], 'export': float(table['world'][i, EXPORT]),
+                     'import': float(table['world'][i, IMPORT]), 'balance': float(balance[i])} for i in rows]
+        mask = table['partners'] & self._not_world()[:, None]
+        if country is not None:
+            i = self.index.get(country)
+            if i is None:
+                return []
+            mask[np.arange(len(self.countries)) != i] = False
+        balance = table['exports'] - table['imports']
+        rows, cols = np.nonzero(mask & (sign * balance > 0))
+        top = np.argsort(-sign * balance[rows, cols], kind='stable')[:limit]
+        return [{'country': self.countries[i], 'partner': self.countries[j], 'export': float(table['exports'][i, j]),
+                 'import': float(table['imports'][i, j]), 'balance': float(balance[i, j])}
+                for i, j in zip(rows[top], cols[top])]
+
+    def summary_documents(self, pairs=None):
+        # country_summaries documents (see trade_queries.write_country_summaries) for every
+        # (year, country) with data, or just the given (year, country) pairs
+        if pairs is None:
+            pairs = ((year, country) for year in self.years for country in self.countries)
+        for year, country in pairs:
+            world_data, partner_data, found = self.country_detail(country, year)
+            if found:
+                yield summary_document(year, country, world_data, partner_data)
+
+    # --- Bilateral lookups for /compare ---
+    def trade_value(self, reporter, partner, flow_desc, year=None):
+        r, p = self.index.get(reporter), self.index.get(partner)
+        year = self.resolve_year(year)
+        if r is None or p is None or year is None:
+            return 0, False, None
+        values, reported = self.values[self.year_index[year]], self.reported[self.year_index[year]]
+        flow = FLOW_INDEX[flow_desc]
+        if reported[r, p, flow]:
+            return float(values[r, p, flow]), True, year
+        mirror_flow = IMPORT if flow == EXPORT else EXPORT
+        if reported[p, r, mirror_flow]:
+            return float(values[p, r, mirror_flow]), False, year
+        return 0, False, None
+
+    # --- Export network edges (World excluded, positive values only) ---
+    def export_edges(self, year=None):
+        year = self.resolve_year(year)
+        if year is None:
+            empty = np.zeros(0, dtype=np.intp)
+            return empty, empty, np.zeros(0)
+        values, reported = self.values[self.year_index[year]], self.reported[self.year_index[year]]
+        keep = self._not_world()
+        mask = reported[:, :, EXPORT] & (values[:, :, EXPORT] > 0)
+        mask &= keep[:, None] & keep[None, :]
+        src, dst = np.nonzero(mask)
+        return src, dst, values[src, dst, EXPORT]
+
+    # --- Incremental updates (see change_feed.py) ---
+    def with_records(self, records, version):
+        # A new matrix with `records` applied on top of this one, or None when a record brings a
+        # country or year the matrix has no row for (the caller then reloads in full)
+        changes = []
+        for record in records:
+            flow = FLOW_INDEX.get(record.get('flow'))
+            if flow is None:
+                continue
+            y, r, p = self.year_index.get(record.get('year')), self.index.get(record.get('reporter')), self.index.get(record.get('partner'))
+            if y is None or r is None or p is None:
+                return None
+            changes.append((y, r, p, flow, record.get('value', 0) or 0))
+        values, reported = self.values.copy(), self.reported.copy() # Copy-on-write: readers keep the old arrays
+        for y, r, p, flow, value in changes:
+            values[y, r, p, flow] = value
+            reported[y, r, p, flow] = True
+        return TradeMatrix(self.countries, self.years, values, reported, version=version)
+
+    # --- Trends across years ---
+    def _years_between(self, year_from=None, year_to=None):
+        return [y for y in self.years if (year_from is None or y >= year_from) and (year_to is None or y <= year_to)]
+
+    def country_trend(self, country, year_from=None, year_to=None):
+        trend = []
+        for year in self._years_between(year_from, year_to):
+            world_data, partner_data, found = self.country_detail(country, year)
+            if found:
+                trend.append({'year': year, 'partners': len(partner_data), **world_data})
+        return trend
+
+    def pair_trend(self, country_A, country_B, year_from=None, year_to=None):
+        trend = []
+        for year in self._years_between(year_from, year_to):
+            A_to_B_value, A_to_B_reported, year1 = self.trade_value(country_A, country_B, "Export", year)
+            B_to_A_value, B_to_A_reported, year2 = self.trade_value(country_B, country_A, "Export", year)
+            if year1 is None and year2 is None:
+                continue
+            trend.append({'year': year, 'A_to_B_value': A_to_B_value, 'A_to_B_reported': A_to_B_reported,
+                          'B_to_A_value': B_to_A_value, 'B_to_A_reported': B_to_A_reported,
+                          'balance': A_to_B_value - B_to_A_value})
+        return trend
+
+
+# --- Process-wide shared matrix with an explicit reload hook ---
+SNAPSHOT_PATH = os.environ.get("TRADE_MATRIX_SNAPSHOT") # Optional .npz/.parquet written by ingest.py
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def get_trade_matrix(db):
+    global _matrix
+    if _matrix is None and (db is not None or SNAPSHOT_PATH):
+        with _matrix_lock:
+            if _matrix is None:
+                if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH):
+                    print(f"Loading trade matrix from snapshot {SNAPSHOT_PATH}...")
+                    with span('matrix_load', 'snapshot'):
+                        _matrix = TradeMatrix.load_snapshot(SNAPSHOT_PATH)
+                elif db is not None:
+                    print("Loading trade matrix from MongoDB...")
+                    with span('matrix_load', 'mongodb'):
+                        _matrix = TradeMatrix.from_collection(db.trade_records)
+                if _matrix is not None:
+                    print(f"Trade matrix loaded: {len(_matrix)} countries, version {_matrix.version}.")
+    return _matrix
+
+
+def patch_trade_matrix(records):
+    # Apply changed records without a collection scan; None means a full refresh is needed
+    global _matrix
+    with _matrix_lock:
+        if _matrix is None:
+            return None
+        with span('matrix_load', 'patch'):
+            patched = _matrix.with_records(records, version=_matrix.version + 1)
+        if patched is not None:
+            _matrix = patched
+    return patched
+
+
+def refresh_trade_matrix(db):
+    # Build the new matrix off to the side, then swap it in so readers never see a half-built one
+    global _matrix
+    version = _matrix.version + 1 if _matrix is not None else 0
+    with span('matrix_load', 'mongodb'):
+        fresh = TradeMatrix.from_collection(db.trade_records, version=version)
+    with _matrix_lock:
+        _matrix = fresh
+    print(f"Trade matrix reloaded: {len(fresh)} countries, version {fresh.version}.")
+    return fresh
@@ -0,0 +1,496 @@
+# trade_queries.py
+# Server-side MongoDB queries for the per-request (non-matrix) code paths.
+import uuid
+from datetime import datetime, timedelta, timezone
+import pymongo
+from pymongo import ReplaceOne, DeleteOne
+from bson import ObjectId
+from metrics import span, count_rows
+
+# Compound indexes: year-first ones back the per-year views (one year's slice, direct or
+# mirror side); year-last ones back the trend queries that span every year of a pair/country
+TRADE_INDEXES = [
+    ([('year', pymongo.ASCENDING), ('reporter', pymongo.ASCENDING), ('partner', pymongo.ASCENDING), ('flow', pymongo.ASCENDING)],
+     'year_reporter_partner_flow', {'unique': True}), # Also the ingest.py upsert key
+    ([('year', pymongo.ASCENDING), ('partner', pymongo.ASCENDING), ('reporter', pymongo.ASCENDING), ('flow', pymongo.ASCENDING)],
+     'year_partner_reporter_flow', {}),
+    ([('reporter', pymongo.ASCENDING), ('partner', pymongo.ASCENDING), ('flow', pymongo.ASCENDING), ('year', pymongo.ASCENDING)],
+     'reporter_partner_flow_year', {}),
+    ([('partner', pymongo.ASCENDING), ('reporter', pymongo.ASCENDING), ('flow', pymongo.ASCENDING), ('year', pymongo.ASCENDING)],
+     'partner_reporter_flow_year', {}),
+    ([('updated_at', pymongo.ASCENDING)], 'updated_at', {}), # Polling watermark for change_feed.py
+    # /data: one year's records by value (optionally one flow), _id breaking ties for the page cursor
+    ([('year', pymongo.ASCENDING), ('value', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)], 'year_value', {}),
+    ([('year', pymongo.ASCENDING), ('flow', pymongo.ASCENDING), ('value', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+     'year_flow_value', {}),
+]
+# country_summaries (see below) is read by _id; these back the ranking queries
+SUMMARY_INDEXES = [
+    ([('year', pymongo.ASCENDING), ('world.balance', pymongo.ASCENDING)], 'year_world_balance', {}),
+    ([('year', pymongo.ASCENDING), ('country', pymongo.ASCENDING)], 'year_country', {}),
+]
+
+
+def ensure_indexes(db):
+    # Each index on its own, so e.g. duplicate legacy rows blocking the unique one don't block the rest
+    for keys, name, options in TRADE_INDEXES:
+        try:
+            db.trade_records.create_index(keys, name=name, **options)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create index {name} on trade_records: {e}")
+    _ensure_summary_indexes(db.country_summaries)
+
+
+def _ensure_summary_indexes(collection):
+    for keys, name, options in SUMMARY_INDEXES:
+        try:
+            collection.create_index(keys, name=name, **options)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create index {name} on {collection.name}: {e}")
+
+
+def empty_world_data():
+    # World totals for a country with no data (the shape country_view.html expects)
+    return {'export': 0, 'import': 0, 'balance': 0, 'export_reported': False, 'import_reported': False, 'export_calculated': False, 'import_calculated': False}
+
+
+# --- Years ---
+def latest_year(db):
+    # Newest year in trade_records (one index lookup), or None when the collection is empty
+    with span('db_query', 'latest_year'):
+        record = db.trade_records.find_one({}, {'_id': 0, 'year': 1}, sort=[('year', pymongo.DESCENDING)])
+    return record.get('year') if record else None
+
+
+def fetch_years(db):
+    with span('db_query', 'years'):
+        return sorted(y for y in db.trade_records.distinct('year') if y is not None)
+
+
+def latest_update(db):
+    record = db.trade_records.find_one({'updated_at': {'$ne': None}}, {'_id': 0, 'updated_at': 1}, sort=[('updated_at', pymongo.DESCENDING)])
+    return record.get('updated_at') if record else None
+
+
+def changes_since(db, watermark, limit=10000, inclusive=False):
+    # Records written (by ingest.py) after `watermark` (or at it, if inclusive), oldest first
+    query = {'updated_at': {'$gte' if inclusive else '$gt': watermark}} if watermark is not None else {'updated_at': {'$ne': None}}
+    projection = {'_id': 0, 'year': 1, 'reporter': 1, 'partner': 1, 'flow': 1, 'value': 1, 'updated_at': 1}
+    with span('db_query', 'changes_since'):
+        return list(db.trade_records.find(query, projection).sort('updated_at', pymongo.ASCENDING).limit(limit))
+
+
+def _year_range(year_from=None, year_to=None):
+    year_filter = {}
+    if year_from is not None:
+        year_filter['$gte'] = year_from
+    if year_to is not None:
+        year_filter['$lte'] = year_to
+    return year_filter
+
+
+def _flow_value(is_direct, flow):
+    # Value of `flow` as reported by `is_direct` side, else None (ignored by $max)
+    return {'$max': {'$cond': [{'$and': [{'$eq': ['$direct', is_direct]}, {'$eq': ['$flow', flow]}]}, '$value', None]}}
+
+
+def _merged_partner_stages(country, group_by_year=False):
+    # Direct + mirror records -> one row per partner (per year when group_by_year)
+    counterpart = {'country': '$counterpart', 'year': '$year'} if group_by_year else '$counterpart'
+    return [
+        {'$project': {
+            '_id': 0, 'flow': 1, 'value': 1, 'year': 1,
+            # A self-reported record (reporter == partner == country) counts as both direct and mirror
+            'direct': {'$cond': [{'$and': [{'$eq': ['$reporter', country]}, {'$eq': ['$partner', country]}]},
+                                 [True, False], {'$cond': [{'$eq': ['$reporter', country]}, [True], [False]]}]},
+            'counterpart': {'$cond': [{'$eq': ['$reporter', country]}, '$partner', '$reporter']},
+        }},
+        {'$unwind': '$direct'},
+        # Direct figures plus the partner's mirror figures
+        # (partner's Import from country = country's Export to partner, and vice versa)
+        {'$group': {
+            '_id': counterpart,
+            'export_direct': _flow_value(True, 'Export'), 'import_direct': _flow_value(True, 'Import'),
+            'export_mirror': _flow_value(False, 'Import'), 'import_mirror': _flow_value(False, 'Export'),
+            'year': {'$max': '$year'},
+        }},
+        {'$project': {
+            'year': 1,
+            'export_reported': {'$ne': [{'$ifNull': ['$export_direct', None]}, None]},
+            'import_reported': {'$ne': [{'$ifNull': ['$import_direct', None]}, None]},
+            'export': {'$ifNull': ['$export_direct', {'$ifNull': ['$export_mirror', 0]}]},
+            'import': {'$ifNull': ['$import_direct', {'$ifNull': ['$import_mirror', 0]}]},
+        }},
+    ]
+
+
+def country_detail_pipeline(country, year):
+    return [
+        {'$match': {'year': year, '$or': [{'reporter': country}, {'partner': country}]}},
+        *_merged_partner_stages(country),
+        {'$facet': {
+            'partners': [{'$match': {'_id': {'$ne': 'World'}}}, {'$sort': {'_id': 1}}],
+            'world': [{'$match': {'_id': 'World'}}],
+            'totals': [
+                {'$match': {'_id': {'$ne': 'World'}}},
+                {'$group': {'_id': None, 'export': {'$sum': '$export'}, 'import': {'$sum': '$import'}, 'year': {'$max': '$year'}}},
+            ],
+        }},
+    ]
+
+
+def country_detail_from_db(db, country, year=None):
+    # Returns (world_data, partner_data, data_found, trade_year) in the shape country_view.html expects;
+    # year=None means the latest year in the collection
+    world_data = empty_world_data()
+    if year is None:
+        year = latest_year(db)
+    with span('db_query', 'country_detail'):
+        result = next(db.trade_records.aggregate(country_detail_pipeline(country, year)), None) or {}
+    partners, world, totals = result.get('partners', []), result.get('world', []), result.get('totals', [])
+    count_rows('country_detail', len(partners) + len(world))
+    if not partners and not world:
+        return world_data, {}, False, "N/A"
+
+    partner_data = {}
+    for row in partners:
+        partner_data[row['_id']] = {
+            'export': row['export'], 'import': row['import'], 'balance': row['export'] - row['import'],
+            'export_reported': row['export_reported'], 'import_reported': row['import_reported'],
+        }
+
+    world_row = world[0] if world else {}
+    totals_row = totals[0] if totals else {}
+    for key in ('export', 'import'):
+        if world_row.get(key + '_reported'):
+            world_data[key] = world_row[key]; world_data[key + '_reported'] = True
+        else:
+            world_data[key] = totals_row.get(key, 0); world_data[key + '_calculated'] = True # Calculated from partners
+    world_data['balance'] = world_data['export'] - world_data['import']
+
+    years = [row['year'] for row in (world_row, totals_row) if row.get('year') is not None]
+    trade_year = max(years) if years else "N/A"
+    return world_data, partner_data, True, trade_year
+
+
+# --- Bilateral lookups for /compare and /api/compare_batch ---
+def _pair_clauses(pairs):
+    clauses = []
+    for country_A, country_B in {tuple(sorted(pair)) for pair in pairs}:
+        clauses.append({'reporter': country_A, 'partner': country_B})
+        clauses.append({'reporter': country_B, 'partner': country_A})
+    return clauses
+
+
+def _trade_value_function(records):
+    # records: {(reporter, partner, flow): record} for a single year
+    def get_trade_value(reporter, partner, flow_desc):
+        # Try direct report first, then the partner's mirror report
+        direct_result = records.get((reporter, partner, flow_desc))
+        if direct_result:
+            return direct_result.get('value', 0), True, direct_result.get('year', None)
+        mirror_flow_desc = "Import" if flow_desc == "Export" else "Export"
+        mirror_result = records.get((partner, reporter, mirror_flow_desc))
+        if mirror_result:
+            return mirror_result.get('value', 0), False, mirror_result.get('year', None)
+        return 0, False, None
+
+    return get_trade_value
+
+
+def bilateral_lookup_from_db(db, pairs, year=None):
+    # One $or query for every direct and mirror record of every pair in `year` (latest when None);
+    # returns a get_trade_value(reporter, partner, flow) function answered from those records
+    clauses = _pair_clauses(pairs)
+    records = {}
+    if clauses:
+        if year is None:
+            year = latest_year(db)
+        projection = {'_id': 0, 'reporter': 1, 'partner': 1, 'flow': 1, 'value': 1, 'year': 1}
+        with span('db_query', 'bilateral'):
+            for record in db.trade_records.find({'year': year, '$or': clauses}, projection):
+                records[(record['reporter'], record['partner'], record['flow'])] = record
+        count_rows('bilateral', len(records))
+    return _trade_value_function(records)
+
+
+def bilateral_summary(get_trade_value, country_A, country_B):
+    # A -> B is A's Export to B (prioritize A's report); B -> A is B's Export to A, i.e. A's Imports
+    A_to_B_value, A_to_B_reported, year1 = get_trade_value(country_A, country_B, "Export")
+    B_to_A_value, B_to_A_reported, year2 = get_trade_value(country_B, country_A, "Export")
+    trade_year = year1 if year1 is not None else year2 if year2 is not None else "N/A"
+    return {
+        'A_to_B_value': A_to_B_value,
+        'A_to_B_reported': A_to_B_reported, # True if A reported Export to B
+        'B_to_A_value': B_to_A_value,
+        'B_to_A_reported': B_to_A_reported, # True if B reported Export to A
+        'balance': A_to_B_value - B_to_A_value, # From A's perspective (A's Exports - A's Imports)
+        'year': trade_year,
+    }
+
+
+def fetch_distinct_countries(db):
+    # All reporters and partners except 'World', sorted
+    pipeline = [
+        {'$match': {'reporter': {'$ne': 'World'}, 'partner': {'$ne': 'World'}}}, # Exclude 'World'
+        {'$group': {'_id': None, 'reporters': {'$addToSet': '$reporter'}, 'partners': {'$addToSet': '$partner'}}},
+        {'$project': {'allCountries': {'$setUnion': ['$reporters', '$partners']}, '_id': 0}}
+    ]
+    with span('db_query', 'distinct_countries'):
+        result = list(db.trade_records.aggregate(pipeline))
+    if result and 'allCountries' in result[0]:
+        return sorted(result[0]['allCountries'])
+    print("Could not retrieve distinct countries, falling back to reporters only.")
+    return sorted(db.trade_records.distinct("reporter", {"reporter": {"$ne": "World"}}))
+
+
+# --- Trends: one query for every year of a country or a pair ---
+def country_trend_pipeline(country, year_from=None, year_to=None):
+    match = {'$or': [{'reporter': country}, {'partner': country}]}
+    year_filter = _year_range(year_from, year_to)
+    if year_filter:
+        match['year'] = year_filter
+    is_partner = {'$ne': ['$_id.country', 'World']}
+    world_value = lambda key: {'$max': {'$cond': [{'$and': [{'$eq': ['$_id.country', 'World']}, '$' + key + '_reported']}, '$' + key, None]}}
+    return [
+        {'$match': match},
+        *_merged_partner_stages(country, group_by_year=True),
+        # Per year: reported World totals where present, else the sum over partners
+        {'$group': {
+            '_id': '$_id.year',
+            'partners': {'$sum': {'$cond': [is_partner, 1, 0]}},
+            'export_sum': {'$sum': {'$cond': [is_partner, '$export', 0]}},
+            'import_sum': {'$sum': {'$cond': [is_partner, '$import', 0]}},
+            'export_world': world_value('export'), 'import_world': world_value('import'),
+        }},
+        {'$sort': {'_id': 1}},
+    ]
+
+
+def country_trend_from_db(db, country, year_from=None, year_to=None):
+    # [{year, partners, export, import, balance, *_reported, *_calculated}, ...] oldest first
+    trend = []
+    with span('db_query', 'country_trend'):
+        rows = list(db.trade_records.aggregate(country_trend_pipeline(country, year_from, year_to)))
+    count_rows('country_trend', len(rows))
+    for row in rows:
+        point = {'year': row['_id'], 'partners': row['partners']}
+        for key in ('export', 'import'):
+            reported = row.get(key + '_world') is not None
+            point[key] = row[key + '_world'] if reported else row[key + '_sum']
+            point[key + '_reported'], point[key + '_calculated'] = reported, not reported
+        point['balance'] = point['export'] - point['import']
+        trend.append(point)
+    return trend
+
+
+def pair_trend_from_db(db, country_A, country_B, year_from=None, year_to=None):
+    # [{year, A_to_B_value, ..., balance}, ...] oldest first, from one indexed query
+    query = {'$or': _pair_clauses([(country_A, country_B)])}
+    year_filter = _year_range(year_from, year_to)
+    if year_filter:
+        query['year'] = year_filter
+    projection = {'_id': 0, 'reporter': 1, 'partner': 1, 'flow': 1, 'value': 1, 'year': 1}
+    by_year, documents = {}, 0
+    with span('db_query', 'pair_trend'):
+        for record in db.trade_records.find(query, projection):
+            by_year.setdefault(record['year'], {})[(record['reporter'], record['partner'], record['flow'])] = record
+            documents += 1
+    count_rows('pair_trend', documents)
+    return [{**bilateral_summary(_trade_value_function(by_year[year]), country_A, country_B), 'year': year}
+            for year in sorted(by_year)]
+
+
+# --- Raw records for /data: filtered, sorted by value, cursor-paginated or streamed ---
+RECORD_FIELDS = ('year', 'reporter', 'partner', 'flow', 'value')
+
+
+def records_query(year, flow=None, reporter=None, partner=None, min_value=None, max_value=None):
+    query = {'year': year}
+    for field, value in (('flow', flow), ('reporter', reporter), ('partner', partner)):
+        if value:
+            query[field] = value
+    value_range = {}
+    if min_value is not None:
+        value_range['$gte'] = min_value
+    if max_value is not None:
+        value_range['$lte'] = max_value
+    if value_range:
+        query['value'] = value_range
+    return query
+
+
+def _records_cursor(db, query, descending):
+    direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+    projection = {field: 1 for field in RECORD_FIELDS}
+    return db.trade_records.find(query, projection).sort([('value', direction), ('_id', direction)])
+
+
+def records_page_from_db(db, query, descending=True, after=None, limit=50):
+    # (records, next_key): one page after the cursor key [value, _id] of the previous page's last row;
+    # next_key is None on the last page
+    if after is not None:
+        value, record_id = after
+        record_id = ObjectId(record_id) if ObjectId.is_valid(record_id) else record_id
+        beyond = '$lt' if descending else '$gt'
+        query = {'$and': [query, {'$or': [{'value': {beyond: value}}, {'value': value, '_id': {beyond: record_id}}]}]}
+    with span('db_query', 'records_page'):
+        records = list(_records_cursor(db, query, descending).limit(limit + 1))
+    count_rows('records_page', len(records))
+    next_key = [records[limit - 1]['value'], str(records[limit - 1]['_id'])] if len(records) > limit else None
+    return [{field: record.get(field) for field in RECORD_FIELDS} for record in records[:limit]], next_key
+
+
+def iter_records_from_db(db, query, descending=True, batch_size=1000):
+    # Every matching record, fetched from the server batch by batch as the caller consumes them
+    documents = 0
+    for record in _records_cursor(db, query, descending).batch_size(batch_size):
+        documents += 1
+        yield {field: record.get(field) for field in RECORD_FIELDS}
+    count_rows('records_export', documents)
+
+
+# --- country_summaries: every country's reconciled partner table, materialized ---
+# One document per (year, country), built in one batch pass (TradeMatrix.summary_documents)
+# by ingest.py and /reload_data and patched by the change feed, so /country_detail is a
+# single keyed read and cross-country rankings are index or small-array scans.
+SUMMARY_META_ID = '_meta' # {years, built_at}: which years the view covers
+SUMMARY_FIELDS = ('export', 'import', 'balance', 'export_reported', 'import_reported')
+
+
+def _summary_id(year, country):
+    return f"{year}|{country}"
+
+
+def summary_document(year, country, world_data, partner_data):
+    partners = [{'partner': partner, **{key: row[key] for key in SUMMARY_FIELDS}} for partner, row in partner_data.items()]
+    return {'_id': _summary_id(year, country), 'year': year, 'country': country, 'world': world_data,
+            'partners': partners, 'partner_count': len(partners)}
+
+
+def _summary_meta(db):
+    return db.country_summaries.find_one({'_id': SUMMARY_META_ID})
+
+
+def country_summary_from_db(db, country, year=None):
+    # Same result as country_detail_from_db, or None when the view doesn't cover the year (yet)
+    if year is None:
+        year = latest_year(db)
+    with span('db_query', 'country_summary'):
+        doc = db.country_summaries.find_one({'_id': _summary_id(year, country)})
+    if doc is None:
+        meta = _summary_meta(db)
+        if meta is None or year not in meta.get('years', []):
+            return None
+        world_data = empty_world_data()
+        return world_data, {}, False, "N/A"
+    count_rows('country_summary', 1)
+    partner_data = {row['partner']: {key: row[key] for key in SUMMARY_FIELDS} for row in doc['partners']}
+    return doc['world'], partner_data, True, doc['year']
+
+
+def write_country_summaries(db, documents, years, chunk_size=1000):
+    # Full rebuild into a side collection that is then renamed over country_summaries, so
+    # readers see the old view or the complete new one, never a mix. Returns documents written.
+    build = db[f"country_summaries_build_{uuid.uuid4().hex[:8]}"] # Per builder: workers may rebuild at once
+    written, chunk = 0, []
+    try:
+        with span('db_query', 'write_country_summaries'):
+            for doc in documents:
+                chunk.append(doc)
+                if len(chunk) >= chunk_size:
+                    build.insert_many(chunk, ordered=False)
+                    written, chunk = written + len(chunk), []
+            if chunk:
+                build.insert_many(chunk, ordered=False)
+                written += len(chunk)
+            build.insert_one({'_id': SUMMARY_META_ID, 'years': list(years), 'built_at': datetime.now(timezone.utc)})
+            _ensure_summary_indexes(build)
+            build.rename('country_summaries', dropTarget=True)
+    except Exception:
+        build.drop()
+        raise
+    return written
+
+
+def update_country_summaries(db, documents, affected=()):
+    # The change feed's patch: replace `documents` in place and delete the affected (year, country)
+    # pairs that no longer have one. A no-op until a full build exists.
+    if _summary_meta(db) is None:
+        return 0
+    operations = [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in documents]
+    kept = {doc['_id'] for doc in documents}
+    operations += [DeleteOne({'_id': _summary_id(year, country)}) for year, country in affected
+                   if _summary_id(year, country) not in kept]
+    if operations:
+        with span('db_query', 'update_country_summaries'):
+            db.country_summaries.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def rank_countries_from_db(db, year, order='surplus', limit=20):
+    # Countries by World balance (largest surplus or deficit first); None when not materialized
+    if _summary_meta(db) is None:
+        return None
+    surplus = order == 'surplus'
+    query = {'year': year, 'country': {'$ne': 'World'}, 'world.balance': {'$gt': 0} if surplus else {'$lt': 0}}
+    projection = {'_id': 0, 'country': 1, 'world': 1}
+    sort = [('world.balance', pymongo.DESCENDING if surplus else pymongo.ASCENDING), ('country', pymongo.ASCENDING)]
+    with span('db_query', 'rank_countries'):
+        rows = [{'country': doc['country'], 'export': doc['world']['export'], 'import': doc['world']['import'],
+                 'balance': doc['world']['balance']}
+                for doc in db.country_summaries.find(query, projection).sort(sort).limit(limit)]
+    count_rows('rank_countries', len(rows))
+    return rows
+
+
+def rank_partners_from_db(db, year, order='surplus', limit=20, country=None):
+    # Country-partner pairs by the country's balance with the partner; None when not materialized
+    if _summary_meta(db) is None:
+        return None
+    surplus = order == 'surplus'
+    match = {'year': year, 'country': country if country is not None else {'$ne': 'World'}}
+    direction = pymongo.DESCENDING if surplus else pymongo.ASCENDING
+    pipeline = [
+        {'$match': match},
+        {'$unwind': '$partners'},
+        {'$match': {'partners.balance': {'$gt': 0} if surplus else {'$lt': 0}}},
+        {'$sort': {'partners.balance': direction, 'country': pymongo.ASCENDING, 'partners.partner': pymongo.ASCENDING}},
+        {'$limit': limit},
+        {'$project': {'_id': 0, 'country': 1, 'partner': '$partners.partner', 'export': '$partners.export',
+                      'import': '$partners.import', 'balance': '$partners.balance'}},
+    ]
+    with span('db_query', 'rank_partners'):
+        rows = list(db.country_summaries.aggregate(pipeline))
+    count_rows('rank_partners', len(rows))
+    return rows
+
+
+# --- trade_meta: coordination between app server processes ---
+def acquire_lease(db, name, owner, seconds):
+    # Whether `owner` holds lease `name` for the next `seconds`: taken when free or expired,
+    # extended when already held, refused while another owner's is live
+    now = datetime.now(timezone.utc)
+    try:
+        db.trade_meta.update_one({'_id': name, '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]},
+                                 {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=seconds)}}, upsert=True)
+        return True
+    except pymongo.errors.DuplicateKeyError: # Held by someone else: the upsert collided with it
+        return False
+
+
+DATA_VERSION_ID = 'data_version'
+
+
+def shared_data_version(db):
+    # Bumped after bulk loads and reloads (see bump_data_version); app processes follow it
+    doc = db.trade_meta.find_one({'_id': DATA_VERSION_ID})
+    return doc['version'] if doc else 0
+
+
+def bump_data_version(db):
+    # Tells every app process to reload trade_records from scratch; returns the new version
+    doc = db.trade_meta.find_one_and_update({'_id': DATA_VERSION_ID},
+                                            {'$inc': {'version': 1}, '$set': {'updated_at': datetime.now(timezone.utc)}},
+                                            upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    return doc['version']